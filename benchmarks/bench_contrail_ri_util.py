@@ -0,0 +1,159 @@
+"""Benchmark contrail_ri_util.py against the fake API server.
+
+Starts a FakeContrailApiServer with a synthetic topology, runs list,
+list --target, show, enable-routing and disable-routing against it in
+separate processes and reports for each command the wall time, the
+number of API requests and the peak RSS of the process.
+
+The results can be saved with --save and compared to a saved run with
+--compare, the exit status is 1 if a command got slower or issued more
+requests than the tolerance allows.
+"""
+
+import argparse
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from fake_contrail_api import FakeContrailApiServer
+
+UTIL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         os.pardir, 'contrail_ri_util.py')
+
+# route target used by the enable-routing / disable-routing runs
+BENCH_TARGET = '64512:7999999'
+
+
+def get_commands(topology):
+    vns = sorted((obj for obj in topology.objects.values()
+                  if obj['_type'] == 'virtual-network'),
+                 key=lambda obj: obj['fq_name'])
+    left, right = vns[0]['uuid'], vns[1]['uuid']
+    # the first route target of the topology is shared by the networks
+    # of the first project
+    shared_target = min(obj['name'] for obj in topology.objects.values()
+                        if obj['_type'] == 'route-target')
+    routing = ['--left-network', left, '--right-network', right,
+               '--target', BENCH_TARGET]
+    return [
+        ('list', ['list']),
+        ('list --target', ['list', '--target',
+                           shared_target.split(':', 1)[1]]),
+        ('show', ['show', left]),
+        ('enable-routing', ['enable-routing'] + routing),
+        ('disable-routing', ['disable-routing'] + routing),
+    ]
+
+
+def run_command(server, argv):
+    """Run contrail_ri_util.py with argv, return (wall, requests, rss)."""
+    server.reset_counters()
+    with open(os.devnull, 'w') as devnull:
+        start = time.time()
+        process = subprocess.Popen([sys.executable, UTIL_PATH] + argv,
+                                   stdout=devnull, stderr=devnull)
+        _, status, rusage = os.wait4(process.pid, 0)
+        wall = time.time() - start
+        process.returncode = status
+    if status:
+        raise RuntimeError('%s exited with status %d'
+                           % (' '.join(argv), os.WEXITSTATUS(status)))
+    # ru_maxrss is in kilobytes on Linux
+    return wall, server.request_count, rusage.ru_maxrss
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if not base:
+            continue
+        for metric in ('wall', 'requests'):
+            if result[metric] > base[metric] * (1 + tolerance):
+                regressions.append('%s: %s %s -> %s' % (
+                    name, metric, base[metric], result[metric]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark '
+                                     'contrail_ri_util.py')
+    parser.add_argument('--tenants', type=int, default=1)
+    parser.add_argument('--vns', type=int, default=200,
+                        help='virtual networks per project')
+    parser.add_argument('--ris-per-vn', type=int, default=1)
+    parser.add_argument('--rts-per-ri', type=int, default=2)
+    parser.add_argument('--latency', type=float, default=0.002,
+                        help='seconds of latency added to every request')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs of every command, the best is reported')
+    parser.add_argument('--util-args', default='',
+                        help='extra global options of contrail_ri_util.py, '
+                        'e.g. --util-args="--bulk --concurrency 16"')
+    parser.add_argument('--save', help='write the results to this file')
+    parser.add_argument('--compare',
+                        help='results file of a previous run to compare to')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed relative regression with --compare')
+    args = parser.parse_args()
+
+    server = FakeContrailApiServer(
+        ('127.0.0.1', 0),
+        topology_args={'tenants': args.tenants, 'vns': args.vns,
+                       'ris_per_vn': args.ris_per_vn,
+                       'rts_per_ri': args.rts_per_ri},
+        latency=args.latency)
+    server.start()
+    host, port = server.server_address
+    cache_dir = tempfile.mkdtemp()
+    # every run starts with a cold fq_name cache
+    base_argv = ['-U', 'admin', '-P', 'secret', '-s', host, '-p', str(port),
+                 '--fqname-cache-file',
+                 os.path.join(cache_dir, 'fqname-to-id.json')]
+    base_argv += shlex.split(args.util_args)
+
+    commands = get_commands(server.topology)
+    results = {}
+    try:
+        for _ in range(args.repeat):
+            for name, argv in commands:
+                shutil.rmtree(cache_dir)
+                os.mkdir(cache_dir)
+                wall, requests, rss = run_command(server, base_argv + argv)
+                best = results.get(name)
+                if not best or wall < best['wall']:
+                    results[name] = {'wall': round(wall, 4),
+                                     'requests': requests, 'peak_rss_kb': rss}
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        server.shutdown()
+
+    print ('Topology: %d tenants x %d VNs x %d RIs x %d RTs, %.1fms latency'
+           % (args.tenants, args.vns, args.ris_per_vn, args.rts_per_ri,
+              args.latency * 1000))
+    print ('%-18s %10s %10s %14s' % ('command', 'wall (s)', 'requests',
+                                      'peak RSS (KB)'))
+    for name, _ in commands:
+        result = results[name]
+        print ('%-18s %10.3f %10d %14d' % (name, result['wall'],
+                                            result['requests'],
+                                            result['peak_rss_kb']))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print ('REGRESSION %s' % regression)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,342 @@
+"""Local stand-in for the OpenContrail API server.
+
+Serves a synthetic VN -> RI -> RT topology with just enough of the REST
+API for contrail_ri_util.py: object GETs, collection listings (detail,
+fields, obj_uuids, parent_id, back_ref_id and pagination), fqname-to-id,
+route target / routing instance creation, ref-update and DELETE.
+"""
+
+import argparse
+import BaseHTTPServer
+import json
+import random
+import SocketServer
+import threading
+import time
+import urlparse
+import uuid
+
+
+class FakeContrailTopology(object):
+
+    def __init__(self, tenants=1, vns=10, ris_per_vn=1, rts_per_ri=1,
+                 asn=64512, host='127.0.0.1', port=8082, seed=0):
+        self.base_url = 'http://%s:%s' % (host, port)
+        # the same arguments always generate the same uuids
+        self._random = random.Random(seed)
+        self.lock = threading.RLock()
+        self.objects = {}
+        self.fq_names = {}
+        self._last_modified = 0
+        target_no = 8000000
+        for t in range(tenants):
+            project = self._add('project', ['default-domain', 'tenant%d' % t],
+                                None)
+            # every other network of a tenant shares one route target
+            shared_rt = None
+            if vns > 1:
+                target_no += 1
+                shared_rt = self._add('route-target',
+                                      ['target:%d:%d' % (asn, target_no)],
+                                      None)
+            for v in range(vns):
+                vn_name = 'vn%d' % v
+                vn = self._add('virtual-network',
+                               project['fq_name'] + [vn_name], project)
+                vn['network_ipam_refs'] = [{
+                    'to': ['default-domain', 'default-project',
+                           'default-network-ipam'],
+                    'attr': {'ipam_subnets': [{
+                        'subnet_uuid': self._new_uuid(),
+                        'subnet': {'ip_prefix': '10.%d.%d.0' % (t, v % 256),
+                                   'ip_prefix_len': 24}}]}}]
+                for r in range(ris_per_vn):
+                    ri_name = vn_name if r == 0 else '%s-ri%d' % (vn_name, r)
+                    ri = self._add('routing-instance',
+                                   vn['fq_name'] + [ri_name], vn)
+                    for _ in range(rts_per_ri):
+                        target_no += 1
+                        rt = self._add('route-target',
+                                       ['target:%d:%d' % (asn, target_no)],
+                                       None)
+                        self._add_ref(ri, rt, None)
+                    if r == 0 and shared_rt and v % 2 == 0:
+                        self._add_ref(ri, shared_rt, None)
+
+    def _new_uuid(self):
+        return str(uuid.UUID(int=self._random.getrandbits(128), version=4))
+
+    def _touch(self, obj):
+        self._last_modified += 1
+        obj['id_perms'] = {'last_modified': '2015-01-01T00:00:00.%06d'
+                           % self._last_modified,
+                           'uuid': {}}
+
+    def _href(self, obj_type, obj_uuid):
+        return '%s/%s/%s' % (self.base_url, obj_type, obj_uuid)
+
+    def _add(self, obj_type, fq_name, parent, obj_uuid=None):
+        obj_uuid = obj_uuid or self._new_uuid()
+        obj = {'uuid': obj_uuid, 'fq_name': list(fq_name),
+               'name': fq_name[-1],
+               'href': self._href(obj_type, obj_uuid)}
+        if parent:
+            obj['parent_uuid'] = parent['uuid']
+            obj['parent_href'] = parent['href']
+            obj['parent_type'] = parent['_type']
+            children = '%ss' % obj_type.replace('-', '_')
+            parent.setdefault(children, []).append(
+                {'to': obj['fq_name'], 'href': obj['href'],
+                 'uuid': obj_uuid})
+            self._touch(parent)
+        obj['_type'] = obj_type
+        self._touch(obj)
+        self.objects[obj_uuid] = obj
+        self.fq_names[(obj_type, tuple(fq_name))] = obj_uuid
+        return obj
+
+    def _add_ref(self, ri, rt, direction):
+        ref = {'to': rt['fq_name'], 'href': rt['href'], 'uuid': rt['uuid'],
+               'attr': {'import_export': direction}}
+        ri.setdefault('route_target_refs', []).append(ref)
+        rt.setdefault('routing_instance_back_refs', []).append(
+            {'to': ri['fq_name'], 'href': ri['href'], 'uuid': ri['uuid'],
+             'attr': {'import_export': direction}})
+        self._touch(ri)
+        self._touch(rt)
+
+    def _del_ref(self, ri, rt):
+        ri['route_target_refs'] = [r for r in ri.get('route_target_refs', [])
+                                   if r['uuid'] != rt['uuid']]
+        rt['routing_instance_back_refs'] = [
+            r for r in rt.get('routing_instance_back_refs', [])
+            if r['uuid'] != ri['uuid']]
+        self._touch(ri)
+        self._touch(rt)
+
+    @staticmethod
+    def public(obj, fields=None):
+        ret = dict((k, v) for k, v in obj.items() if not k.startswith('_'))
+        if fields is not None:
+            keep = set(['uuid', 'fq_name', 'href', 'parent_uuid',
+                        'parent_href', 'parent_type', 'name']) | set(fields)
+            ret = dict((k, v) for k, v in ret.items() if k in keep)
+        return ret
+
+    def list(self, obj_type, query):
+        def _split(key):
+            value = query.get(key)
+            return set(value[0].split(',')) if value else None
+
+        parent_ids = _split('parent_id')
+        obj_uuids = _split('obj_uuids')
+        back_ref_ids = _split('back_ref_id')
+        fields = _split('fields')
+        detail = query.get('detail', ['false'])[0].lower() == 'true'
+        page_limit = int(query.get('page_limit', ['0'])[0])
+        page_marker = query.get('page_marker', [None])[0]
+
+        objs = sorted((o for o in self.objects.values()
+                       if o['_type'] == obj_type), key=lambda o: o['uuid'])
+        if parent_ids is not None:
+            objs = [o for o in objs if o.get('parent_uuid') in parent_ids]
+        if obj_uuids is not None:
+            objs = [o for o in objs if o['uuid'] in obj_uuids]
+        if back_ref_ids is not None:
+            objs = [o for o in objs
+                    if back_ref_ids & set(r['uuid'] for r in
+                                          o.get('route_target_refs', []))]
+        if page_marker:
+            objs = [o for o in objs if o['uuid'] > page_marker]
+        marker = None
+        if page_limit and len(objs) > page_limit:
+            objs = objs[:page_limit]
+            marker = objs[-1]['uuid']
+
+        if detail:
+            items = [{obj_type: self.public(o, fields)} for o in objs]
+        else:
+            items = [{'href': o['href'], 'fq_name': o['fq_name'],
+                      'uuid': o['uuid']} for o in objs]
+            if fields:
+                for item, o in zip(items, objs):
+                    item.update((f, o[f]) for f in fields if f in o)
+        ret = {'%ss' % obj_type: items}
+        if page_limit:
+            ret['marker'] = marker
+        return ret
+
+
+class FakeContrailHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # buffer the response so that it goes out in one segment
+    wbufsize = -1
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, body=None):
+        # like the API server, errors are reported as plain text
+        content_type = 'application/json'
+        if status >= 400:
+            content_type = 'text/plain'
+            data = body['error']
+        else:
+            data = json.dumps(body) if body is not None else ''
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        self.wfile.flush()
+
+    def _start(self):
+        self.server.count_request(self.command, self.path)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        parsed = urlparse.urlsplit(self.path)
+        parts = [p for p in parsed.path.split('/') if p]
+        return parts, urlparse.parse_qs(parsed.query)
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length)) if length else {}
+
+    def do_GET(self):
+        parts, query = self._start()
+        topo = self.server.topology
+        with topo.lock:
+            if len(parts) == 1 and parts[0].endswith('s'):
+                return self._reply(200, topo.list(parts[0][:-1], query))
+            if len(parts) == 2:
+                obj = topo.objects.get(parts[1])
+                if obj and obj['_type'] == parts[0]:
+                    return self._reply(200, {parts[0]: topo.public(obj)})
+        self._reply(404, {'error': 'not found'})
+
+    def do_POST(self):
+        parts, _ = self._start()
+        topo = self.server.topology
+        body = self._body()
+        with topo.lock:
+            if parts == ['fqname-to-id']:
+                obj_uuid = topo.fq_names.get((body['type'],
+                                              tuple(body['fq_name'])))
+                if not obj_uuid:
+                    return self._reply(404, {'error': 'not found'})
+                return self._reply(200, {'uuid': obj_uuid})
+            if parts == ['route-targets']:
+                fq_name = body['route-target']['fq_name']
+                if ('route-target', tuple(fq_name)) in topo.fq_names:
+                    return self._reply(409, {'error': 'exists'})
+                rt = topo._add('route-target', fq_name, None)
+                return self._reply(200, {'route-target': topo.public(rt)})
+            if parts == ['routing-instances']:
+                fq_name = body['routing-instance']['fq_name']
+                if ('routing-instance', tuple(fq_name)) in topo.fq_names:
+                    return self._reply(409, {'error': 'exists'})
+                vn_uuid = topo.fq_names.get(('virtual-network',
+                                             tuple(fq_name[:-1])))
+                if not vn_uuid:
+                    return self._reply(404, {'error': 'parent not found'})
+                ri = topo._add('routing-instance', fq_name,
+                               topo.objects[vn_uuid])
+                return self._reply(200, {'routing-instance': topo.public(ri)})
+            if parts == ['ref-update']:
+                ri = topo.objects.get(body['uuid'])
+                rt = topo.objects.get(body['ref-uuid'])
+                if not ri or not rt:
+                    return self._reply(404, {'error': 'not found'})
+                if body['operation'] == 'ADD':
+                    topo._add_ref(ri, rt, (body.get('attr') or {}).get(
+                        'import_export'))
+                else:
+                    topo._del_ref(ri, rt)
+                return self._reply(200, {'uuid': ri['uuid']})
+        self._reply(404, {'error': 'not found'})
+
+    def do_DELETE(self):
+        parts, _ = self._start()
+        topo = self.server.topology
+        with topo.lock:
+            obj = topo.objects.get(parts[1]) if len(parts) == 2 else None
+            if not obj or obj['_type'] != parts[0]:
+                return self._reply(404, {'error': 'not found'})
+            if (obj.get('routing_instance_back_refs') or
+                    obj.get('route_target_refs')):
+                return self._reply(409, {'error': 'object has references'})
+            del topo.objects[obj['uuid']]
+            del topo.fq_names[(obj['_type'], tuple(obj['fq_name']))]
+            parent = topo.objects.get(obj.get('parent_uuid'))
+            if parent:
+                children = '%ss' % obj['_type'].replace('-', '_')
+                parent[children] = [c for c in parent.get(children, [])
+                                    if c['uuid'] != obj['uuid']]
+                topo._touch(parent)
+        self._reply(200)
+
+
+class FakeContrailApiServer(SocketServer.ThreadingMixIn,
+                            BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    # the default backlog of 5 makes concurrent clients wait for a SYN
+    # retransmission
+    request_queue_size = 128
+
+    def __init__(self, address, topology_args=None, latency=0.0):
+        BaseHTTPServer.HTTPServer.__init__(self, address, FakeContrailHandler)
+        host, port = self.server_address
+        self.topology = FakeContrailTopology(host=host, port=port,
+                                             **(topology_args or {}))
+        self.latency = latency
+        self._count_lock = threading.Lock()
+        self.reset_counters()
+
+    def count_request(self, method, path):
+        with self._count_lock:
+            self.request_count += 1
+            resource = urlparse.urlsplit(path).path.split('/')[1]
+            key = '%s %s' % (method, resource)
+            self.requests_by_endpoint[key] = (
+                self.requests_by_endpoint.get(key, 0) + 1)
+
+    def reset_counters(self):
+        with self._count_lock:
+            self.request_count = 0
+            self.requests_by_endpoint = {}
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake OpenContrail API '
+                                     'server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8082)
+    parser.add_argument('--tenants', type=int, default=1,
+                        help='number of projects')
+    parser.add_argument('--vns', type=int, default=10,
+                        help='virtual networks per project')
+    parser.add_argument('--ris-per-vn', type=int, default=1,
+                        help='routing instances per virtual network')
+    parser.add_argument('--rts-per-ri', type=int, default=1,
+                        help='route targets per routing instance')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds of latency added to every request')
+    args = parser.parse_args()
+    server = FakeContrailApiServer(
+        (args.host, args.port),
+        topology_args={'tenants': args.tenants, 'vns': args.vns,
+                       'ris_per_vn': args.ris_per_vn,
+                       'rts_per_ri': args.rts_per_ri},
+        latency=args.latency)
+    print ('Serving fake API server on %s:%s' % server.server_address)
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,358 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Benchmarks of ContrailOsloLogger.
+
+construct: time the creation of loggers for N generators sharing one
+logging configuration file. Only the first one should parse the file
+and set up the handlers.
+
+throughput: drive one logger with a synthetic generator at a given
+message rate and level mix, writing to a log file and to a local UDP
+socket standing in for syslog. Reports messages/sec, the p50/p99
+latency of a log call and, for every handler, the time spent
+formatting the records compared with the time spent writing them.
+--logger stdlib runs the same workload through a plain python logger
+formatted like sandesh's default one for comparison.
+"""
+
+import argparse
+import logging
+import logging.handlers
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+import contrail_oslo_logger
+
+timer = getattr(time, 'perf_counter', time.time)
+
+SAMPLE_CONF = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'contrail_oslo_sample.conf')
+
+# format of the records of sandesh's default logger
+SANDESH_LOG_FORMAT = '%(asctime)s [%(name)s]: %(message)s'
+
+MESSAGES = [
+    ('Peer %s:%d connection state changed to %s',
+     lambda rand: ('10.0.%d.%d' % (rand.randint(0, 255),
+                                   rand.randint(1, 254)),
+                   rand.choice((179, 5269, 8086)),
+                   rand.choice(('Established', 'Active', 'Idle')))),
+    ('Virtual network %s: routing instance %s updated, %d routes',
+     lambda rand: ('default-domain:admin:vn%d' % rand.randint(0, 999),
+                   'ri%d' % rand.randint(0, 999), rand.randint(0, 10000))),
+    ('Sandesh send queue %s, %d messages pending',
+     lambda rand: (rand.choice(('high', 'low')), rand.randint(0, 5000))),
+]
+
+
+def write_config(log_dir, **options):
+    config = {'debug': 'True',
+              'use_stderr': 'False',
+              'log_file': os.path.join(log_dir, 'bench.log')}
+    config.update(options)
+    path = os.path.join(log_dir, 'bench.conf')
+    with open(path, 'w') as f:
+        f.write('[DEFAULT]\n')
+        for key, value in sorted(config.items()):
+            f.write('%s = %s\n' % (key, value))
+    return path
+
+
+def get_sample_formats():
+    """Return the logging_*_format_string options of the sample conf."""
+    formats = {}
+    with open(SAMPLE_CONF) as f:
+        for line in f:
+            key, sep, value = line.partition('=')
+            key = key.strip()
+            if sep and key.startswith('logging_') and \
+                    key.endswith('_format_string'):
+                formats[key] = value.strip()
+    return formats
+
+
+def parse_level_mix(level_mix):
+    """Parse DEBUG:70,INFO:30 into [(levelno, weight)]."""
+    mix = []
+    for item in level_mix.split(','):
+        level, _, weight = item.partition(':')
+        levelno = logging.getLevelName(level.strip().upper())
+        if not isinstance(levelno, int):
+            raise ValueError('Unknown log level %s' % level)
+        mix.append((levelno, float(weight or 1)))
+    return mix
+
+
+class SyslogStandIn(object):
+    """UDP socket counting the datagrams sent by a SysLogHandler."""
+
+    def __init__(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(('127.0.0.1', 0))
+        self.socket.settimeout(0.2)
+        self.address = self.socket.getsockname()
+        self.datagrams = 0
+        self.bytes = 0
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped:
+            try:
+                data = self.socket.recv(65536)
+            except socket.timeout:
+                continue
+            self.datagrams += 1
+            self.bytes += len(data)
+
+    def stop(self):
+        self._stopped = True
+        self._thread.join()
+        self.socket.close()
+
+
+class HandlerTimer(object):
+    """Time the format() and handle() calls of a handler."""
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.name = type(handler).__name__
+        self.records = 0
+        self.format_time = 0.0
+        self.handle_time = 0.0
+        self._format = handler.format
+        self._handle = handler.handle
+        handler.format = self.format
+        handler.handle = self.handle
+
+    def format(self, record):
+        start = timer()
+        try:
+            return self._format(record)
+        finally:
+            self.format_time += timer() - start
+
+    def handle(self, record):
+        start = timer()
+        try:
+            return self._handle(record)
+        finally:
+            self.records += 1
+            self.handle_time += timer() - start
+
+
+def get_handlers():
+    """Return the lists holding the handlers of ContrailOsloLogger."""
+    handler_lists = [logging.getLogger().handlers]
+    # in async mode the listener thread owns the real handlers
+    listener = contrail_oslo_logger._async_listener
+    if listener:
+        handler_lists.append(listener._handlers)
+    return handler_lists
+
+
+def redirect_syslog(handler_lists, address):
+    """Replace the syslog handlers by ones sending to address."""
+    for handlers in handler_lists:
+        for i, handler in enumerate(handlers):
+            if 'SysLog' not in type(handler).__name__:
+                continue
+            udp_handler = logging.handlers.SysLogHandler(address=address)
+            udp_handler.setLevel(handler.level)
+            udp_handler.setFormatter(handler.formatter)
+            for log_filter in handler.filters:
+                udp_handler.addFilter(log_filter)
+            handler.close()
+            handlers[i] = udp_handler
+
+
+def get_stdlib_logger(log_dir, address):
+    logger = logging.getLogger('bench-stdlib')
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    formatter = logging.Formatter(SANDESH_LOG_FORMAT)
+    for handler in (logging.FileHandler(os.path.join(log_dir, 'bench.log')),
+                    logging.handlers.SysLogHandler(address=address)):
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
+    return logger, [logger.handlers]
+
+
+def get_oslo_logger(args, log_dir, address):
+    options = {'use_syslog': 'True'}
+    if args.async_logging:
+        options['async_logging'] = 'True'
+    if args.sample_formats:
+        options.update(get_sample_formats())
+    config_file = write_config(log_dir, **options)
+    oslo_logger = contrail_oslo_logger.ContrailOsloLogger('bench-generator',
+                                                          config_file)
+    handler_lists = get_handlers()
+    redirect_syslog(handler_lists, address)
+    return oslo_logger.logger(), handler_lists
+
+
+def percentile(sorted_values, percent):
+    index = int(round(percent / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def bench_throughput(args, log_dir):
+    syslog = SyslogStandIn()
+    if args.logger == 'stdlib':
+        logger, handler_lists = get_stdlib_logger(log_dir, syslog.address)
+    else:
+        logger, handler_lists = get_oslo_logger(args, log_dir,
+                                                syslog.address)
+    timers = [HandlerTimer(handler) for handlers in handler_lists
+              for handler in handlers
+              if not isinstance(handler,
+                                contrail_oslo_logger._LogQueueHandler)]
+
+    rand = random.Random(args.seed)
+    mix = parse_level_mix(args.level_mix)
+    total_weight = sum(weight for _, weight in mix)
+    workload = []
+    for _ in range(args.messages):
+        pick = rand.uniform(0, total_weight)
+        for levelno, weight in mix:
+            pick -= weight
+            if pick <= 0:
+                break
+        msg, get_args = rand.choice(MESSAGES)
+        workload.append((levelno, msg, get_args(rand)))
+
+    latencies = []
+    start = timer()
+    for i, (levelno, msg, msg_args) in enumerate(workload):
+        if args.rate:
+            delay = start + float(i) / args.rate - timer()
+            if delay > 0:
+                time.sleep(delay)
+        call_start = timer()
+        logger.log(levelno, msg, *msg_args)
+        latencies.append(timer() - call_start)
+    calls_elapsed = timer() - start
+    contrail_oslo_logger.flush_async_logging()
+    for handlers in handler_lists:
+        for handler in handlers:
+            handler.flush()
+    elapsed = timer() - start
+    # give the stand-in a chance to read the last datagrams
+    time.sleep(0.3)
+    syslog.stop()
+
+    latencies.sort()
+    print ('logger              %s%s' % (
+        args.logger, ' (async)' if args.async_logging and
+        args.logger == 'oslo' else ''))
+    print ('messages            %d in %.3f s, %.0f msgs/sec (%.0f calls/sec)'
+           % (len(workload), elapsed, len(workload) / elapsed,
+              len(workload) / calls_elapsed))
+    print ('call latency        p50 %.1f us, p99 %.1f us, max %.1f us'
+           % (percentile(latencies, 50) * 1e6,
+              percentile(latencies, 99) * 1e6, latencies[-1] * 1e6))
+    print ('%-19s %8s %14s %14s' % ('handler', 'records', 'format us/rec',
+                                    'I/O us/rec'))
+    for handler_timer in timers:
+        records = handler_timer.records or 1
+        print ('%-19s %8d %14.1f %14.1f' % (
+            handler_timer.name, handler_timer.records,
+            handler_timer.format_time * 1e6 / records,
+            (handler_timer.handle_time - handler_timer.format_time) *
+            1e6 / records))
+    print ('syslog stand-in     %d datagrams, %d bytes received'
+           % (syslog.datagrams, syslog.bytes))
+    return len(workload) / elapsed
+
+
+def bench_construct(args, config_file):
+    timings = []
+    for i in range(args.generators):
+        start = time.time()
+        contrail_oslo_logger.ContrailOsloLogger('generator-%d' % i,
+                                                config_file)
+        timings.append(time.time() - start)
+
+    print ('first logger        %10.3f ms' % (timings[0] * 1000))
+    if len(timings) > 1:
+        others = timings[1:]
+        print ('next %-6d loggers %10.3f ms total, %.3f ms each'
+               % (len(others), sum(others) * 1000,
+                  sum(others) * 1000 / len(others)))
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark '
+                                     'ContrailOsloLogger')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    construct_parser = subparsers.add_parser(
+        'construct', help='time the creation of loggers for N generators')
+    construct_parser.add_argument('--generators', type=int, default=100)
+    construct_parser.add_argument(
+        '--max-per-logger-ms', type=float, default=None,
+        help='exit with status 1 if a logger after the first one takes '
+        'longer than this on average')
+    throughput_parser = subparsers.add_parser(
+        'throughput', help='log a synthetic workload to a file and syslog')
+    throughput_parser.add_argument('--messages', type=int, default=50000)
+    throughput_parser.add_argument(
+        '--rate', type=float, default=0,
+        help='messages per second, 0 logs as fast as possible')
+    throughput_parser.add_argument(
+        '--level-mix', default='DEBUG:70,INFO:25,WARNING:4,ERROR:1',
+        help='relative weights of the levels of the messages')
+    throughput_parser.add_argument('--logger', default='oslo',
+                                   choices=('oslo', 'stdlib'))
+    throughput_parser.add_argument(
+        '--sample-formats', action='store_true',
+        help='use the format strings of contrail_oslo_sample.conf')
+    throughput_parser.add_argument('--async-logging', action='store_true')
+    throughput_parser.add_argument('--seed', type=int, default=0)
+    throughput_parser.add_argument(
+        '--min-rate', type=float, default=None,
+        help='exit with status 1 if less messages/sec are logged')
+    args = parser.parse_args()
+
+    log_dir = tempfile.mkdtemp()
+    try:
+        if args.benchmark == 'throughput':
+            rate = bench_throughput(args, log_dir)
+        else:
+            config_file = write_config(log_dir)
+            timings = bench_construct(args, config_file)
+    finally:
+        contrail_oslo_logger.flush_async_logging()
+        shutil.rmtree(log_dir, ignore_errors=True)
+
+    if args.benchmark == 'throughput':
+        if args.min_rate is not None and rate < args.min_rate:
+            sys.exit(1)
+        return
+
+    others = timings[1:]
+    if (args.max_per_logger_ms is not None and others and
+            sum(others) * 1000 / len(others) > args.max_per_logger_ms):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -11,7 +11,20 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import atexit
+import logging as std_logging
+import mmap
 import os
+import struct
+import sys
+import threading
+import time
+import traceback
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 from oslo_config import cfg
 from oslo_log import log as logging
@@ -19,20 +32,582 @@ from oslo_log import log as logging
 from pysandesh import sandesh_base_logger
 
 
-class ContrailOsloLogger(sandesh_base_logger.SandeshBaseLogger):
-    def __init__(self, generator, logger_config_file=None):
-        if not os.path.exists(logger_config_file):
-            raise Exception('%s file not present ' % logger_config_file)
+async_opts = [
+    cfg.BoolOpt('async_logging', default=False,
+                help='Hand the log records to a dedicated thread which '
+                     'writes them to the configured handlers'),
+    cfg.IntOpt('async_log_queue_size', default=10000,
+               help='Maximum number of log records waiting to be written '
+                    'in async mode'),
+    cfg.StrOpt('async_log_overflow_policy', default='drop-debug',
+               choices=('block', 'drop-oldest', 'drop-debug'),
+               help='What to do with a record when the queue is full: '
+                    'block the caller, drop the oldest queued record or '
+                    'drop the record if it is a DEBUG one and block '
+                    'otherwise'),
+]
+
+filter_opts = [
+    cfg.FloatOpt('log_rate_limit_interval', default=0,
+                 help='Interval in seconds of the per message template rate '
+                      'limit, 0 disables it'),
+    cfg.IntOpt('log_rate_limit_burst', default=10,
+               help='Records of one message template allowed per interval'),
+    cfg.DictOpt('log_rate_limit_per_level', default={},
+                help='Records allowed per interval for specific levels, '
+                     'e.g. DEBUG:5,INFO:20. 0 disables the limit for '
+                     'a level'),
+    cfg.StrOpt('log_rate_limit_except_level', default='CRITICAL',
+               help='Records of this level and above are never rate '
+                    'limited'),
+    cfg.BoolOpt('log_collapse_duplicates', default=False,
+                help='Replace consecutive identical records of a logger '
+                     'by a single "repeated N times" record'),
+]
+
+ring_buffer_opts = [
+    cfg.StrOpt('log_ring_buffer_file', default=None,
+               help='Memory mapped file keeping the last formatted records '
+                    'for crash forensics, see contrail_oslo_ring_dump.py'),
+    cfg.IntOpt('log_ring_buffer_size', default=8 * 1024 * 1024,
+               help='Size in bytes of the ring buffer'),
+    cfg.StrOpt('log_ring_buffer_level', default='DEBUG',
+               help='Records of this level and above are written to the '
+                    'ring buffer, the other handlers keep the configured '
+                    'level'),
+]
+
+
+def _get_levelno(level_name):
+    levelno = std_logging.getLevelName(level_name.upper())
+    if not isinstance(levelno, int):
+        raise ValueError('Unknown log level %s' % level_name)
+    return levelno
+
+
+class _LogSuppressor(object):
+    """Rate limit and duplicate suppression of the generator loggers.
+
+    Every message template (logger, level and unformatted message) has
+    a token bucket refilled with burst tokens per interval. Consecutive
+    identical messages of a logger are counted instead of being logged
+    when collapse_duplicates is set. _install_log_suppression() hooks
+    suppress() in the _log() method of the loggers: it runs after the
+    level check and before the caller is looked up and the record is
+    built, so a suppressed message costs a dict lookup under a lock.
+
+    The suppressed messages are counted and reported by a record of the
+    same template (or logger), or by flush(). A timer calls flush()
+    every flush interval while counts are pending and
+    flush_async_logging() calls it at exit.
+    """
+
+    # buckets kept before the idle ones are dropped
+    max_buckets = 10000
+    # flush interval of the duplicates without a rate limit interval
+    duplicates_flush_interval = 1.0
+
+    def __init__(self, interval, burst, level_bursts, except_levelno,
+                 collapse_duplicates):
+        self._interval = interval
+        self._burst = burst
+        self._level_bursts = level_bursts
+        self._except_levelno = except_levelno
+        self._collapse_duplicates = collapse_duplicates
+        self._flush_interval = interval or self.duplicates_flush_interval
+        # template -> [tokens, last refill time, suppressed messages]
+        self._buckets = {}
+        # logger name -> [level, msg, args, repeated messages]
+        self._last_messages = {}
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def _emit_summaries(self, name, summaries):
+        logger = std_logging.getLogger(name)
+        for levelno, msg, count in summaries:
+            logger.callHandlers(logger.makeRecord(
+                name, levelno, '(unknown file)', 0, msg, (count,), None))
+
+    def _schedule_flush(self):
+        if self._timer:
+            return
+        self._timer = threading.Timer(self._flush_interval, self.flush)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _is_duplicate(self, name, levelno, msg, args):
+        last = self._last_messages.get(name)
+        if (last and last[0] == levelno and last[1] == msg and
+                last[2] == args):
+            last[3] += 1
+            return True, None
+
+        self._last_messages[name] = [levelno, msg, args, 0]
+        if last and last[3]:
+            return False, (last[0], 'Last message repeated %d times',
+                           last[3])
+        return False, None
+
+    def _is_rate_limited(self, name, levelno, msg):
+        if not self._interval or levelno >= self._except_levelno:
+            return False, None
+        burst = self._level_bursts.get(levelno, self._burst)
+        if not burst:
+            return False, None
+
+        now = time.time()
+        key = (name, levelno, msg)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= self.max_buckets:
+                self._drop_idle_buckets(now)
+            bucket = self._buckets[key] = [burst, now, 0]
+        else:
+            bucket[0] = min(burst, bucket[0] +
+                            (now - bucket[1]) * burst / self._interval)
+            bucket[1] = now
+        if bucket[0] < 1:
+            bucket[2] += 1
+            return True, None
+
+        bucket[0] -= 1
+        if bucket[2]:
+            suppressed = bucket[2]
+            bucket[2] = 0
+            return False, (levelno, '%d similar messages were rate limited',
+                           suppressed)
+        return False, None
+
+    def _drop_idle_buckets(self, now):
+        # a bucket untouched for an interval is full again, it is the
+        # same as no bucket unless it has suppressed messages to report
+        for key, bucket in list(self._buckets.items()):
+            if now - bucket[1] >= self._interval and not bucket[2]:
+                del self._buckets[key]
+        if len(self._buckets) >= self.max_buckets:
+            self._buckets.clear()
+
+    def suppress(self, name, levelno, msg, args):
+        """Return True if the message should not be logged."""
+        summaries = []
+        with self._lock:
+            if self._collapse_duplicates:
+                duplicate, summary = self._is_duplicate(name, levelno, msg,
+                                                        args)
+                if duplicate:
+                    self._schedule_flush()
+                    return True
+                if summary:
+                    summaries.append(summary)
+            limited, summary = self._is_rate_limited(name, levelno, msg)
+            if summary:
+                summaries.append(summary)
+            if limited:
+                self._schedule_flush()
+        if summaries:
+            self._emit_summaries(name, summaries)
+        return limited
+
+    def flush(self):
+        """Log the counts of the messages suppressed so far."""
+        summaries = {}
+        with self._lock:
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+            for name, last in self._last_messages.items():
+                if last[3]:
+                    summaries.setdefault(name, []).append(
+                        (last[0], 'Last message repeated %d times',
+                         last[3]))
+                    last[3] = 0
+            for (name, levelno, _), bucket in self._buckets.items():
+                if bucket[2]:
+                    summaries.setdefault(name, []).append(
+                        (levelno, '%d similar messages were rate limited',
+                         bucket[2]))
+                    bucket[2] = 0
+        for name, name_summaries in summaries.items():
+            self._emit_summaries(name, name_summaries)
+
+
+def _find_caller(stack_info=False, stacklevel=1):
+    """findCaller() of the loggers with _install_log_suppression().
+
+    Like the one of the logging module, but the _log() hook of this
+    module is not the caller either.
+    """
+    internal_files = (std_logging._srcfile, _srcfile)
+    frame = sys._getframe(1)
+    while (frame and
+           os.path.normcase(frame.f_code.co_filename) in internal_files):
+        frame = frame.f_back
+    while frame and stacklevel > 1:
+        frame = frame.f_back
+        if (frame and os.path.normcase(frame.f_code.co_filename) not in
+                internal_files):
+            stacklevel -= 1
+    if not frame:
+        caller = ('(unknown file)', 0, '(unknown function)')
+    else:
+        caller = (frame.f_code.co_filename, frame.f_lineno,
+                  frame.f_code.co_name)
+    if sys.version_info[0] == 2:
+        return caller
+    stack = None
+    if stack_info and frame:
+        stack = 'Stack (most recent call last):\n%s' % ''.join(
+            traceback.format_stack(frame)).rstrip('\n')
+    return caller + (stack,)
+
+
+def _install_log_suppression(logger):
+    """Hook the current _log_suppressor in the _log() of logger.
+
+    The suppressor is looked up for every message, the loggers created
+    before a reconfiguration use the new one.
+    """
+    if '_log' in logger.__dict__:
+        return
+    log = type(logger)._log
+
+    def _log(level, msg, args, *log_args, **kwargs):
+        suppressor = _log_suppressor
+        if suppressor and suppressor.suppress(logger.name, level, msg,
+                                              args):
+            return
+        log(logger, level, msg, args, *log_args, **kwargs)
+
+    logger._log = _log
+    logger.findCaller = _find_caller
+
+_srcfile = os.path.normcase(_install_log_suppression.__code__.co_filename)
+
+
+class _LogQueueHandler(std_logging.Handler):
+    """Handler putting the records in a bounded queue."""
+
+    def __init__(self, log_queue, overflow_policy):
+        std_logging.Handler.__init__(self)
+        self._queue = log_queue
+        self._overflow_policy = overflow_policy
+        # not the handler lock, emit() may block on a full queue with
+        # the handler lock held
+        self._dropped_lock = threading.Lock()
+        self._dropped = 0
+
+    def _drop(self):
+        with self._dropped_lock:
+            self._dropped += 1
+
+    def take_dropped(self):
+        """Return and reset the number of dropped records."""
+        with self._dropped_lock:
+            dropped = self._dropped
+            self._dropped = 0
+        return dropped
+
+    def _prepare(self, record):
+        # merge the arguments now, they may be changed by the caller
+        # before the listener formats the record
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def emit(self, record):
+        try:
+            record = self._prepare(record)
+        except Exception:
+            self.handleError(record)
+            return
+
+        try:
+            self._queue.put_nowait(record)
+            return
+        except queue.Full:
+            pass
+
+        if self._overflow_policy == 'drop-oldest':
+            while True:
+                try:
+                    self._queue.get_nowait()
+                    self._drop()
+                except queue.Empty:
+                    pass
+                try:
+                    self._queue.put_nowait(record)
+                    return
+                except queue.Full:
+                    pass
+        elif (self._overflow_policy == 'drop-debug' and
+                record.levelno <= std_logging.DEBUG):
+            self._drop()
+        else:
+            self._queue.put(record)
+
+
+class _LogQueueListener(object):
+    """Thread writing the queued records to the handlers."""
+
+    _sentinel = None
+
+    def __init__(self, log_queue, queue_handler, handlers):
+        self._queue = log_queue
+        self._queue_handler = queue_handler
+        self._handlers = handlers
+        self._thread = threading.Thread(target=self._run,
+                                        name='contrail-oslo-logger')
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def _handle(self, record):
+        for handler in self._handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def _report_dropped(self):
+        dropped = self._queue_handler.take_dropped()
+        if not dropped:
+            return
+        self._handle(std_logging.makeLogRecord({
+            'name': __name__, 'levelno': std_logging.WARNING,
+            'levelname': 'WARNING',
+            'msg': 'Log queue full, %d records were dropped' % dropped}))
+
+    def _run(self):
+        while True:
+            record = self._queue.get()
+            if record is self._sentinel:
+                break
+            self._handle(record)
+            self._report_dropped()
+
+    def stop(self, timeout=10):
+        """Write the queued records and stop the thread."""
+        if not self._thread.is_alive():
+            return
+        self._queue.put(self._sentinel)
+        self._thread.join(timeout)
+        self._report_dropped()
+        for handler in self._handlers:
+            handler.flush()
+
+
+class _RingBufferHandler(std_logging.Handler):
+    """Handler writing the formatted records in a memory mapped ring.
+
+    The file starts with a header (magic, size of the data area, bytes
+    ever written, last record number) followed by the data area where
+    the frames (magic, length, record number, utf-8 message) wrap
+    around. Writing a record is a copy into the mapping, the kernel
+    writes the pages back so the ring survives a crash of the process.
+    A ring of the same size left by a previous run is continued.
+    """
+
+    header = struct.Struct('<8sQQQ')
+    header_size = 64
+    magic = b'CTRLRING'
+    frame = struct.Struct('<4sIQ')
+    frame_magic = b'CRLR'
+
+    def __init__(self, path, size):
+        std_logging.Handler.__init__(self)
+        self._size = size
+        file_size = self.header_size + size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o640)
+        try:
+            if os.fstat(fd).st_size != file_size:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, file_size)
+            self._mmap = mmap.mmap(fd, file_size)
+        finally:
+            os.close(fd)
+
+        magic, ring_size, written, number = self.header.unpack(
+            self._mmap[:self.header.size])
+        if magic != self.magic or ring_size != size:
+            written, number = 0, 0
+        self._written = written
+        self._number = number
+
+    def _copy(self, data):
+        offset = self._written % self._size
+        first = min(len(data), self._size - offset)
+        start = self.header_size + offset
+        self._mmap[start:start + first] = data[:first]
+        if first < len(data):
+            self._mmap[self.header_size:
+                       self.header_size + len(data) - first] = data[first:]
+        self._written += len(data)
+
+    def emit(self, record):
+        try:
+            data = self.format(record)
+            # a python 2 str record is already encoded, possibly not in
+            # ascii, encoding it again would decode it as ascii first
+            if not isinstance(data, bytes):
+                data = data.encode('utf-8', 'replace')
+            data = data[:self._size // 2]
+            self._number += 1
+            self._copy(self.frame.pack(self.frame_magic, len(data),
+                                       self._number) + data)
+            self._mmap[:self.header.size] = self.header.pack(
+                self.magic, self._size, self._written, self._number)
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        self.acquire()
+        try:
+            if self._mmap:
+                self._mmap.close()
+                self._mmap = None
+        finally:
+            self.release()
+        std_logging.Handler.close(self)
+
+
+_ring_handler = None
+
+
+def _setup_ring_buffer(conf, handlers):
+    """Add a _RingBufferHandler to the root logger.
+
+    The root logger level is lowered to log_ring_buffer_level and the
+    other handlers get the configured level instead, so only the ring
+    pays for the extra records.
+    """
+    global _ring_handler
+
+    root = std_logging.getLogger()
+    ring_handler = _RingBufferHandler(conf.log_ring_buffer_file,
+                                      conf.log_ring_buffer_size)
+    ring_levelno = _get_levelno(conf.log_ring_buffer_level)
+    ring_handler.setLevel(ring_levelno)
+    for handler in handlers:
+        if handler.formatter:
+            ring_handler.setFormatter(handler.formatter)
+            break
+
+    for handler in root.handlers:
+        handler.setLevel(max(handler.level, root.level))
+    root.setLevel(min(root.level, ring_levelno))
+    # in front of the async queue, the records queued when the process
+    # crashes are in the ring
+    root.addHandler(ring_handler)
+    _ring_handler = ring_handler
+
+
+_async_listener = None
+
+
+def _setup_async_logging(conf):
+    """Move the root logger handlers behind a queue and a listener."""
+    global _async_listener
+
+    if _async_listener:
+        _async_listener.stop()
+        _async_listener = None
+
+    root = std_logging.getLogger()
+    handlers = list(root.handlers)
+    log_queue = queue.Queue(conf.async_log_queue_size)
+    queue_handler = _LogQueueHandler(log_queue,
+                                     conf.async_log_overflow_policy)
+    for handler in handlers:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+
+    _async_listener = _LogQueueListener(log_queue, queue_handler, handlers)
+    _async_listener.start()
+
+
+def flush_async_logging():
+    """Flush the suppressed counts and the async logging queue.
+
+    The queued records are written and the async logging thread is
+    stopped.
+    """
+    global _async_listener
+
+    if _log_suppressor:
+        _log_suppressor.flush()
+    if _async_listener:
+        _async_listener.stop()
+        _async_listener = None
+
+atexit.register(flush_async_logging)
+
+
+_setup_lock = threading.Lock()
+_configured_file = None
+_log_suppressor = None
+
+
+def _setup_logging(logger_config_file):
+    """Parse logger_config_file and set up the oslo_log handlers.
+
+    This is done once per process; loggers created with the same file
+    share the parsed configuration and the handlers.
+    """
+    global _configured_file
+    global _log_suppressor
+    global _ring_handler
+
+    logger_config_file = os.path.abspath(logger_config_file)
+    with _setup_lock:
+        if _configured_file == logger_config_file:
+            return
 
         opts = [
             cfg.StrOpt('test', default=None),
         ]
         args = ['--config-file', logger_config_file]
-        logging.set_defaults()
-        logging.register_options(cfg.CONF)
+        if _configured_file is None:
+            logging.set_defaults()
+            logging.register_options(cfg.CONF)
+            cfg.CONF.register_opts(async_opts)
+            cfg.CONF.register_opts(filter_opts)
+            cfg.CONF.register_opts(ring_buffer_opts)
         cfg.CONF(args=args)
         # there is a bug in older versions of oslo_config. This is
         # just a workaround
         cfg.CONF.register_opts(opts)
+        if _ring_handler:
+            _ring_handler.close()
+            _ring_handler = None
+        # report the counts of the previous configuration to its handlers
+        if _log_suppressor:
+            _log_suppressor.flush()
         logging.setup(cfg.CONF, "contrail")
+        handlers = list(std_logging.getLogger().handlers)
+        if cfg.CONF.async_logging:
+            _setup_async_logging(cfg.CONF)
+        else:
+            flush_async_logging()
+
+        conf = cfg.CONF
+        if conf.log_ring_buffer_file:
+            _setup_ring_buffer(conf, handlers)
+        _log_suppressor = None
+        if conf.log_rate_limit_interval > 0 or conf.log_collapse_duplicates:
+            _log_suppressor = _LogSuppressor(
+                conf.log_rate_limit_interval, conf.log_rate_limit_burst,
+                dict((_get_levelno(level), int(burst)) for level, burst
+                     in conf.log_rate_limit_per_level.items()),
+                _get_levelno(conf.log_rate_limit_except_level),
+                conf.log_collapse_duplicates)
+        _configured_file = logger_config_file
+
+
+class ContrailOsloLogger(sandesh_base_logger.SandeshBaseLogger):
+    def __init__(self, generator, logger_config_file=None):
+        if not os.path.exists(logger_config_file):
+            raise Exception('%s file not present ' % logger_config_file)
+
+        _setup_logging(logger_config_file)
         self._logger = logging.getLogger(generator)
+        if _log_suppressor:
+            _install_log_suppression(self._logger.logger)
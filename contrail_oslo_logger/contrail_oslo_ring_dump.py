@@ -0,0 +1,94 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Print the records of a ContrailOsloLogger ring buffer file.
+
+The file is the log_ring_buffer_file of the logging configuration, see
+_RingBufferHandler in contrail_oslo_logger.py for its layout. The
+records are printed oldest first. The oldest frame is usually partly
+overwritten, the dump skips to the first complete one.
+"""
+
+import argparse
+import struct
+import sys
+
+HEADER = struct.Struct('<8sQQQ')
+HEADER_SIZE = 64
+MAGIC = b'CTRLRING'
+FRAME = struct.Struct('<4sIQ')
+FRAME_MAGIC = b'CRLR'
+
+
+def read_ring(path):
+    """Return the data of the ring file in write order."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    if len(data) < HEADER_SIZE:
+        raise ValueError('%s is not a ring buffer file' % path)
+    magic, size, written, _ = HEADER.unpack(data[:HEADER.size])
+    if magic != MAGIC or len(data) != HEADER_SIZE + size:
+        raise ValueError('%s is not a ring buffer file' % path)
+
+    ring = data[HEADER_SIZE:]
+    if written <= size:
+        return ring[:written]
+    offset = written % size
+    return ring[offset:] + ring[:offset]
+
+
+def iter_records(data):
+    """Yield (number, message) for the complete frames of data."""
+    last_number = None
+    position = data.find(FRAME_MAGIC)
+    while position != -1 and position + FRAME.size <= len(data):
+        _, length, number = FRAME.unpack(
+            data[position:position + FRAME.size])
+        end = position + FRAME.size + length
+        # a frame whose header was partly overwritten has a bogus length
+        # or number, look for the next one
+        if end <= len(data) and (last_number is None or
+                                 number > last_number):
+            yield number, data[position + FRAME.size:end]
+            last_number = number
+            position = data.find(FRAME_MAGIC, end)
+        else:
+            position = data.find(FRAME_MAGIC, position + 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Print the records of a '
+                                     'ContrailOsloLogger ring buffer')
+    parser.add_argument('ring_file')
+    parser.add_argument('-n', '--tail', type=int, default=None,
+                        help='print only the last N records')
+    parser.add_argument('--numbers', action='store_true',
+                        help='prefix the records with their number')
+    args = parser.parse_args()
+
+    try:
+        records = list(iter_records(read_ring(args.ring_file)))
+    except (IOError, OSError, ValueError) as e:
+        print ('Error : %s' % e)
+        sys.exit(1)
+
+    if args.tail is not None:
+        records = records[-args.tail:] if args.tail else []
+    out = getattr(sys.stdout, 'buffer', sys.stdout)
+    for number, message in records:
+        if args.numbers:
+            out.write(('%d ' % number).encode('ascii'))
+        out.write(message + b'\n')
+    out.flush()
+
+if __name__ == '__main__':
+    main()
@@ -1,35 +1,1216 @@
 import argparse
+import atexit
+import base64
+import binascii
+import collections
+import copy
+import errno
+import httplib
+import itertools
 import random
+import shlex
+import signal
+import socket
+import SocketServer
+import sqlite3
 import subprocess
 import json
+import os
 import sys
+import threading
 import time
+import urllib
+import urlparse
 import uuid
+import Queue
+
+from multiprocessing.pool import ThreadPool
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+
+class ContrailApiConnectionPool(object):
+    """Pool of keep-alive HTTP connections to one API server endpoint.
+
+    At most pool_size connections are open at a time; a caller blocks until
+    one of them is returned to the pool.
+    """
+
+    def __init__(self, host, port, headers, pool_size=4, timeout=None):
+        self._host = host
+        self._port = port
+        self._headers = headers
+        self._timeout = timeout
+        self._idle = Queue.LifoQueue(pool_size)
+        for _ in range(pool_size):
+            self._idle.put(None)
+
+    def _connect(self):
+        return httplib.HTTPConnection(self._host, self._port,
+                                      timeout=self._timeout)
+
+    def _set_timeout(self, conn, timeout):
+        conn.timeout = timeout
+        if conn.sock:
+            conn.sock.settimeout(timeout)
+
+    @staticmethod
+    def _is_closed_connection_error(error):
+        """Return True if error tells the server closed the connection.
+
+        The server did not handle the request then, it can be sent
+        again. A timeout can happen after the server got the request.
+        """
+        if isinstance(error, httplib.BadStatusLine):
+            return True
+        return (isinstance(error, socket.error) and
+                not isinstance(error, socket.timeout) and
+                error.errno in (errno.ECONNRESET, errno.EPIPE))
+
+    def request(self, method, path, body=None, timeout=None):
+        """Send a request and return (status, data).
+
+        timeout, when given, replaces the socket timeout of the pool for
+        this request.
+        """
+        headers = dict(self._headers)
+        if body is not None:
+            headers['Content-Type'] = 'application/json'
+
+        conn = self._idle.get()
+        try:
+            while True:
+                reused = conn is not None
+                if not reused:
+                    conn = self._connect()
+                if timeout is not None:
+                    self._set_timeout(conn, timeout)
+                try:
+                    conn.request(method, path, body, headers)
+                    response = conn.getresponse()
+                except (httplib.HTTPException, socket.error) as e:
+                    conn.close()
+                    conn = None
+                    # the server may have closed an idle kept-alive
+                    # connection, retry once on a fresh one
+                    if reused and self._is_closed_connection_error(e):
+                        continue
+                    raise
+                try:
+                    data = response.read()
+                except (httplib.HTTPException, socket.error):
+                    conn.close()
+                    conn = None
+                    raise
+                if response.will_close:
+                    conn.close()
+                    conn = None
+                elif timeout is not None:
+                    self._set_timeout(conn, self._timeout)
+                return response.status, data
+        finally:
+            self._idle.put(conn)
+
+    def close(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except Queue.Empty:
+                break
+            if conn:
+                conn.close()
+
+
+class DisjointSet(object):
+    """Union-find over hashable items with path compression."""
+
+    def __init__(self):
+        self._parents = {}
+
+    def add(self, item):
+        self._parents.setdefault(item, item)
+
+    def find(self, item):
+        root = item
+        while self._parents[root] != root:
+            root = self._parents[root]
+        while self._parents[item] != root:
+            self._parents[item], item = root, self._parents[item]
+        return root
+
+    def union(self, item, other):
+        self._parents[self.find(item)] = self.find(other)
+
+
+class RouteTarget(object):
+    """Route target, shared by the routing instances referring to it."""
+
+    __slots__ = ('uuid', 'fq_name', 'target')
+
+    def __init__(self, obj_uuid, fq_name, target):
+        self.uuid = obj_uuid
+        self.fq_name = fq_name
+        self.target = target
+
+
+class RoutingInstance(object):
+    """Routing instance and its (RouteTarget, direction) references."""
+
+    __slots__ = ('uuid', 'fq_name', 'route_targets')
+
+    def __init__(self, obj_uuid, fq_name, route_targets):
+        self.uuid = obj_uuid
+        self.fq_name = fq_name
+        self.route_targets = route_targets
+
+    def to_dict(self):
+        return {'fq_name': list(self.fq_name),
+                'uuid': self.uuid,
+                'route_targets': [{'fq_name': list(rt.fq_name),
+                                   'uuid': rt.uuid,
+                                   'target': rt.target,
+                                   'direction': direction}
+                                  for rt, direction in self.route_targets]}
+
+
+class Subnet(object):
+    """Subnet of a virtual network, in CIDR notation."""
+
+    __slots__ = ('subnet_uuid', 'cidr')
+
+    def __init__(self, subnet_uuid, cidr):
+        self.subnet_uuid = subnet_uuid
+        self.cidr = cidr
+
+    def to_dict(self):
+        return {'subnet_uuid': self.subnet_uuid, 'cidr': self.cidr}
+
+
+class VirtualNetwork(object):
+    """Virtual network with its subnets and routing instances.
+
+    subnets is None when they were not read, as for show.
+    """
+
+    __slots__ = ('uuid', 'fq_name', 'tenant_id', 'subnets',
+                 'routing_instances')
+
+    def __init__(self, obj_uuid, fq_name, tenant_id, subnets,
+                 routing_instances):
+        self.uuid = obj_uuid
+        self.fq_name = fq_name
+        self.tenant_id = tenant_id
+        self.subnets = subnets
+        self.routing_instances = routing_instances
+
+    def to_dict(self):
+        """Return the network as the JSON outputs print it."""
+        vnet_info = {'uuid': self.uuid,
+                     'fq_name': list(self.fq_name),
+                     'tenant_id': self.tenant_id}
+        if self.subnets is not None:
+            vnet_info['subnets'] = [subnet.to_dict()
+                                    for subnet in self.subnets]
+        vnet_info['routing_instances'] = [ri.to_dict()
+                                          for ri in self.routing_instances]
+        return vnet_info
+
+
+class ContrailModelBuilder(object):
+    """Build the model of the networks read by a command.
+
+    The fq_names are tuples of shared strings and an fq_name is a single
+    tuple whatever the number of objects having it. The route targets
+    are built once per uuid and shared by the routing instances
+    referring to them.
+    """
+
+    def __init__(self):
+        self._names = {}
+        self._route_targets = {}
+
+    def fq_name(self, fq_name):
+        fq_name = tuple(self._names.setdefault(name, name)
+                        for name in fq_name)
+        return self._names.setdefault(fq_name, fq_name)
+
+    def route_target(self, obj_uuid, fq_name, target):
+        route_target = self._route_targets.get(obj_uuid)
+        if route_target is None:
+            route_target = self._route_targets.setdefault(
+                obj_uuid, RouteTarget(obj_uuid, self.fq_name(fq_name),
+                                      self._names.setdefault(target,
+                                                             target)))
+        return route_target
+
+    def routing_instance(self, obj_uuid, fq_name, route_targets=()):
+        """route_targets are (RouteTarget, direction) pairs."""
+        return RoutingInstance(obj_uuid, self.fq_name(fq_name),
+                               tuple(route_targets))
+
+    def routing_instance_from_object(self, obj):
+        """Build the routing instance of a routing-instance object.
+
+        The route targets are those of its references, named after the
+        last element of their fq_name.
+        """
+        route_targets = []
+        for ref in obj.get('route_target_refs', []):
+            direction = (ref.get('attr') or {}).get('import_export')
+            route_targets.append((self.route_target(ref['uuid'], ref['to'],
+                                                    ref['to'][-1]),
+                                  direction))
+        return self.routing_instance(obj['uuid'], obj['fq_name'],
+                                     route_targets)
+
+    def virtual_network(self, obj_uuid, fq_name, tenant_id, subnets=None,
+                        routing_instances=()):
+        return VirtualNetwork(obj_uuid, self.fq_name(fq_name), tenant_id,
+                              subnets, tuple(routing_instances))
+
+    def virtual_network_from_dict(self, vnet_info):
+        """Build a network from its to_dict() form."""
+        subnets = vnet_info.get('subnets')
+        if subnets is not None:
+            subnets = tuple(Subnet(subnet['subnet_uuid'], subnet['cidr'])
+                            for subnet in subnets)
+        routing_instances = [
+            self.routing_instance(
+                ri['uuid'], ri['fq_name'],
+                [(self.route_target(rt['uuid'], rt['fq_name'],
+                                    rt['target']), rt['direction'])
+                 for rt in ri['route_targets']])
+            for ri in vnet_info['routing_instances']]
+        return self.virtual_network(vnet_info['uuid'], vnet_info['fq_name'],
+                                    vnet_info['tenant_id'], subnets,
+                                    routing_instances)
+
+
+class RouteTargetIndex(object):
+    """Inverted index from route targets to the networks using them.
+
+    A network imports the routes of the networks exporting one of the
+    targets it imports. A route target reference without direction is
+    both imported and exported.
+    """
+
+    def __init__(self):
+        self.networks = collections.OrderedDict()
+        self._imports = {}
+        self._exports = {}
+        self._importers = collections.defaultdict(set)
+        self._exporters = collections.defaultdict(set)
+
+    def add(self, vnet, routing_instances=None):
+        """Index the route targets of the routing instances of vnet."""
+        if routing_instances is None:
+            routing_instances = vnet.routing_instances
+        self.networks[vnet.uuid] = vnet
+        imports = self._imports.setdefault(vnet.uuid, set())
+        exports = self._exports.setdefault(vnet.uuid, set())
+        for ri in routing_instances:
+            for rt, direction in ri.route_targets:
+                if direction != 'export':
+                    imports.add(rt.target)
+                    self._importers[rt.target].add(vnet.uuid)
+                if direction != 'import':
+                    exports.add(rt.target)
+                    self._exporters[rt.target].add(vnet.uuid)
+
+    def get_targets(self, vn_uuid):
+        return self._imports[vn_uuid] | self._exports[vn_uuid]
+
+    def get_networks(self, target):
+        return self._importers[target] | self._exporters[target]
+
+    def common_targets(self, vn_uuids):
+        """Return the targets used by every network of vn_uuids."""
+        return set.intersection(*[self.get_targets(vn_uuid)
+                                  for vn_uuid in vn_uuids])
+
+    def imports_from(self, vn_uuid):
+        """Return the networks whose routes vn_uuid imports."""
+        networks = set()
+        for target in self._imports[vn_uuid]:
+            networks.update(self._exporters[target])
+        networks.discard(vn_uuid)
+        return networks
+
+    def exports_to(self, vn_uuid):
+        """Return the networks importing the routes of vn_uuid."""
+        networks = set()
+        for target in self._exports[vn_uuid]:
+            networks.update(self._importers[target])
+        networks.discard(vn_uuid)
+        return networks
+
+    def get_groups(self):
+        """Return the groups of networks exchanging routes.
+
+        Two networks are in the same group when routes flow between
+        them, possibly through other networks of the group.
+        """
+        groups = DisjointSet()
+        for vn_uuid in self.networks:
+            groups.add(vn_uuid)
+        for target, importers in self._importers.items():
+            # routes flow from every exporter to every importer
+            exporters = self._exporters.get(target)
+            if not importers or not exporters:
+                continue
+            members = importers | exporters
+            first = next(iter(members))
+            for vn_uuid in members:
+                groups.union(vn_uuid, first)
+
+        members = collections.OrderedDict()
+        for vn_uuid in self.networks:
+            members.setdefault(groups.find(vn_uuid), []).append(vn_uuid)
+        return members.values()
+
+
+class RouteTargetAllocator(object):
+    """Index of the route target numbers in use, per ASN.
+
+    The numbers of an ASN are a bitmap. The allocation hands out the
+    first unused number after the last one handed out, so the bitmap is
+    scanned once whatever the number of allocations.
+    """
+
+    # the API server allocates the targets of the networks from 8000000
+    FIRST_NUMBER = 1
+    LAST_NUMBER = 7999999
+
+    def __init__(self):
+        self.loaded = False
+        self._used = {}
+        self._next = {}
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+
+    @staticmethod
+    def parse(target):
+        """Return (asn, number) of target:<asn>:<number>, or None."""
+        parts = target.split(':')
+        if len(parts) != 3 or parts[0] != 'target':
+            return None
+        try:
+            return parts[1], int(parts[2])
+        except ValueError:
+            return None
+
+    def _get_bitmap(self, asn):
+        bitmap = self._used.get(asn)
+        if bitmap is None:
+            bitmap = self._used[asn] = bytearray(self.LAST_NUMBER // 8 + 1)
+            self._next[asn] = self.FIRST_NUMBER
+        return bitmap
+
+    def _mark_used(self, asn, number):
+        if self.FIRST_NUMBER <= number <= self.LAST_NUMBER:
+            self._get_bitmap(asn)[number >> 3] |= 1 << (number & 7)
+
+    def load(self, list_targets):
+        """Mark the targets returned by list_targets() used, once."""
+        with self._load_lock:
+            if self.loaded:
+                return
+            targets = list_targets()
+            with self._lock:
+                for target in targets:
+                    parsed = self.parse(target)
+                    if parsed:
+                        self._mark_used(*parsed)
+            self.loaded = True
+
+    def mark_used(self, target):
+        parsed = self.parse(target)
+        if parsed:
+            with self._lock:
+                self._mark_used(*parsed)
+
+    def reserve(self, asn, count=1):
+        """Return count unused numbers of asn, now marked used."""
+        numbers = []
+        with self._lock:
+            bitmap = self._get_bitmap(asn)
+            number = self._next[asn]
+            while len(numbers) < count:
+                if number > self.LAST_NUMBER:
+                    # the numbers found are left unused
+                    for used in numbers:
+                        bitmap[used >> 3] &= ~(1 << (used & 7)) & 0xff
+                    raise ContrailRouteHelperError(
+                        'No route target number left for ASN %s' % asn)
+                byte = bitmap[number >> 3]
+                if byte == 0xff and not number & 7:
+                    number += 8
+                    continue
+                if not byte & (1 << (number & 7)):
+                    bitmap[number >> 3] = byte | (1 << (number & 7))
+                    numbers.append(number)
+                number += 1
+            self._next[asn] = number
+        return numbers
+
+
+class ContrailObjectCache(object):
+    """Size bounded LRU cache of API server GET responses.
+
+    Entries are keyed by the request path. Object entries are dropped
+    with invalidate() when a write touches the object, collection
+    listings are dropped on every write. With a ttl, entries older than
+    ttl seconds are read again, for long running processes.
+    """
+
+    def __init__(self, max_size, ttl=0):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._pending = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get_or_fetch(self, key, fetch):
+        """Return the cached value of key or cache the result of fetch().
+
+        Concurrent callers asking for the same key share a single fetch.
+        """
+        with self._lock:
+            value = self._get(key)
+            if value is not None:
+                return value
+            event = self._pending.get(key)
+            if not event:
+                event = self._pending[key] = threading.Event()
+                generation = self._generation
+                fetching = True
+            else:
+                fetching = False
+
+        if not fetching:
+            event.wait()
+            value = self.get(key)
+            return value if value is not None else fetch()
+
+        try:
+            value = fetch()
+            with self._lock:
+                # do not cache a value read before an invalidation
+                if value and generation == self._generation:
+                    self._put(key, value)
+            return value
+        finally:
+            with self._lock:
+                del self._pending[key]
+            event.set()
+
+    def get(self, key):
+        with self._lock:
+            return self._get(key)
+
+    def _get(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+        value, expiry = entry
+        if expiry and expiry < time.time():
+            return None
+        self._entries[key] = entry
+        return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._put(key, value)
+
+    def _put(self, key, value):
+        if self._max_size <= 0:
+            return
+        self._entries.pop(key, None)
+        self._entries[key] = (value,
+                              time.time() + self._ttl if self._ttl else None)
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, obj_uuids):
+        """Drop the cached objects with one of obj_uuids and all listings.
+
+        The parent and the (back) referenced objects of a dropped object
+        are dropped as well, their children and references are stale.
+        """
+        obj_uuids = set(obj_uuid for obj_uuid in obj_uuids if obj_uuid)
+        related_uuids = set()
+        with self._lock:
+            self._generation += 1
+            for key, (value, _) in self._entries.items():
+                if '?' in key or key.count('/') == 1:
+                    del self._entries[key]
+                elif key.rsplit('/', 1)[-1] in obj_uuids:
+                    del self._entries[key]
+                    related_uuids.update(self._get_related_uuids(value))
+            for key in self._entries.keys():
+                if key.rsplit('/', 1)[-1] in related_uuids:
+                    del self._entries[key]
+
+    @staticmethod
+    def _get_related_uuids(response):
+        for obj in response.values():
+            if not isinstance(obj, dict):
+                continue
+            yield obj.get('parent_uuid')
+            for field, refs in obj.items():
+                if field.endswith('_refs'):
+                    for ref in refs:
+                        yield ref.get('uuid')
+
+
+class ContrailFqNameCache(object):
+    """File backed cache of fq_name to uuid mappings.
+
+    Mappings expire after ttl seconds and at most max_size of the most
+    recently resolved ones are written back by save(). The file is
+    shared by all the API servers used, keys are prefixed by the server.
+    """
+
+    def __init__(self, path, server, ttl, max_size):
+        self._path = path
+        self._server = server
+        self._ttl = ttl
+        self._max_size = max_size
+        self._entries = self._load() if ttl > 0 else {}
+        self._updates = {}
+        self._removed = set()
+        self._lock = threading.Lock()
+
+    def _load(self):
+        try:
+            with open(self._path) as f:
+                entries = json.load(f)
+        except (IOError, ValueError):
+            return {}
+        return entries if isinstance(entries, dict) else {}
+
+    def _key(self, res_type, fq_name):
+        return '%s %s %s' % (self._server, res_type, ':'.join(fq_name))
+
+    def get(self, res_type, fq_name):
+        if self._ttl <= 0:
+            return None
+        with self._lock:
+            entry = self._entries.get(self._key(res_type, fq_name))
+        if not entry or entry[1] + self._ttl < time.time():
+            return None
+        return entry[0]
+
+    def put(self, res_type, fq_name, obj_uuid):
+        if self._ttl <= 0:
+            return
+        key = self._key(res_type, fq_name)
+        entry = [obj_uuid, time.time()]
+        with self._lock:
+            self._entries[key] = entry
+            self._updates[key] = entry
+            self._removed.discard(key)
+
+    def invalidate(self, res_type, fq_name):
+        with self._lock:
+            self._remove(self._key(res_type, fq_name))
+
+    def invalidate_uuid(self, obj_uuid):
+        with self._lock:
+            for key, entry in self._entries.items():
+                if entry[0] == obj_uuid:
+                    self._remove(key)
+
+    def _remove(self, key):
+        self._entries.pop(key, None)
+        self._updates.pop(key, None)
+        self._removed.add(key)
+
+    def save(self):
+        """Merge the changes of this run into the cache file.
+
+        The lock is held until the file is renamed, the threads of the
+        process share the tmp file. The changes are kept for the next
+        save() if the file can't be written.
+        """
+        with self._lock:
+            if not self._updates and not self._removed:
+                return
+            # other processes may have updated the file since it was read
+            entries = self._load()
+            entries.update(self._updates)
+            for key in self._removed:
+                entries.pop(key, None)
+
+            expiry = time.time() - self._ttl
+            entries = sorted(((key, entry) for key, entry in entries.items()
+                              if entry[1] >= expiry),
+                             key=lambda item: item[1][1], reverse=True)
+            entries = dict(entries[:self._max_size])
+            tmp_path = '%s.%d.tmp' % (self._path, os.getpid())
+            try:
+                cache_dir = os.path.dirname(self._path)
+                if cache_dir and not os.path.isdir(cache_dir):
+                    os.makedirs(cache_dir)
+                with open(tmp_path, 'w') as f:
+                    json.dump(entries, f)
+                os.rename(tmp_path, self._path)
+            except (IOError, OSError) as e:
+                print >>sys.stderr, ('Failed to write the fq_name cache %s : '
+                                     '%s' % (self._path, e))
+                return
+            self._updates = {}
+            self._removed = set()
+
+
+class ContrailRequestTrace(object):
+    """Record of the API requests of a helper, for --profile.
+
+    Every request is recorded with its method, endpoint (the resource
+    type of its path), latency, response size and, for the cached GETs,
+    whether the object cache answered it. The latency percentiles only
+    count the requests sent to the API server.
+    """
+
+    def __init__(self):
+        self._start = time.time()
+        self._records = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @staticmethod
+    def get_endpoint(path):
+        """Return the resource type of path, e.g. virtual-network."""
+        parts = [part for part in path.split('?', 1)[0].split('/') if part]
+        return parts[0] if parts else '/'
+
+    def set_response_size(self, size):
+        """Set the size of the response the calling thread just read."""
+        self._local.size = size
+
+    def record(self, method, path, start, cache=None, failed=False):
+        """Record a request of the calling thread started at start.
+
+        cache is 'hit' or 'miss' for a GET going through the object
+        cache, None otherwise.
+        """
+        size = getattr(self._local, 'size', 0)
+        self._local.size = 0
+        record = {'start': round(start - self._start, 6),
+                  'method': method,
+                  'endpoint': self.get_endpoint(path),
+                  'path': path,
+                  'latency': round(time.time() - start, 6),
+                  'size': size,
+                  'cache': cache,
+                  'failed': failed}
+        with self._lock:
+            self._records.append(record)
+
+    @staticmethod
+    def _percentile(sorted_values, percent):
+        index = int(round(percent / 100.0 * (len(sorted_values) - 1)))
+        return sorted_values[index]
+
+    def get_summary(self, slowest=10):
+        """Return the statistics per endpoint and the slowest requests."""
+        with self._lock:
+            records = list(self._records)
+        endpoints = collections.defaultdict(list)
+        for record in records:
+            endpoints['%s %s' % (record['method'],
+                                 record['endpoint'])].append(record)
+
+        summary = []
+        for name, endpoint_records in sorted(endpoints.items()):
+            latencies = sorted(record['latency']
+                               for record in endpoint_records
+                               if record['cache'] != 'hit')
+            stats = {'endpoint': name,
+                     'requests': len(latencies),
+                     'cache_hits': len(endpoint_records) - len(latencies),
+                     'failed': sum(1 for record in endpoint_records
+                                   if record['failed']),
+                     'bytes': sum(record['size']
+                                  for record in endpoint_records)}
+            for percent in (50, 95, 99):
+                stats['p%d' % percent] = (
+                    self._percentile(latencies, percent)
+                    if latencies else None)
+            stats['max'] = latencies[-1] if latencies else None
+            summary.append(stats)
+
+        sent = [record for record in records if record['cache'] != 'hit']
+        return {'endpoints': summary,
+                'slowest': sorted(sent, key=lambda record: record['latency'],
+                                  reverse=True)[:slowest]}
+
+    def print_summary(self, out, slowest=10):
+        summary = self.get_summary(slowest)
+
+        def _ms(value):
+            return '%.1f' % (value * 1000) if value is not None else '-'
+
+        out.write('API requests\n')
+        out.write('%-28s %8s %8s %6s %10s %8s %8s %8s %8s\n' % (
+            'endpoint', 'requests', 'hits', 'failed', 'bytes', 'p50 ms',
+            'p95 ms', 'p99 ms', 'max ms'))
+        for stats in summary['endpoints']:
+            out.write('%-28s %8d %8d %6d %10d %8s %8s %8s %8s\n' % (
+                stats['endpoint'], stats['requests'], stats['cache_hits'],
+                stats['failed'], stats['bytes'], _ms(stats['p50']),
+                _ms(stats['p95']), _ms(stats['p99']), _ms(stats['max'])))
+        out.write('Slowest requests\n')
+        for record in summary['slowest']:
+            out.write('%8s ms %10d bytes %s %s%s\n' % (
+                _ms(record['latency']), record['size'], record['method'],
+                record['path'], ' FAILED' if record['failed'] else ''))
+        out.flush()
+
+    def save(self, path):
+        """Write the requests and their summary to path as JSON."""
+        with self._lock:
+            records = list(self._records)
+        with open(path, 'w') as f:
+            json.dump({'requests': records,
+                       'endpoints': self.get_summary()['endpoints']}, f,
+                      indent=1)
+
+
+class ContrailRequestPolicy(object):
+    """Retries and hedging of the API requests.
+
+    A GET failing with a connection error, a 5xx or a 429 status is
+    retried up to retries times, after a random delay of up to
+    backoff * 2 ** attempt seconds (capped to max_backoff). With hedge,
+    a GET not answered within the p95 latency of the previous GETs is
+    sent a second time and the first answer is used. A deadline, the
+    time.time() at which a command must end, bounds the retries and the
+    socket timeouts.
+    """
+
+    # GETs whose latency is known before hedging
+    HEDGE_MIN_SAMPLES = 20
+    # latencies kept, the p95 is computed again every REFRESH samples
+    MAX_SAMPLES = 1000
+    REFRESH = 50
+
+    def __init__(self, retries=3, backoff=0.1, max_backoff=5.0,
+                 hedge=False):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.hedge = hedge
+        self._latencies = collections.deque(maxlen=self.MAX_SAMPLES)
+        self._new_samples = 0
+        self._p95 = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def should_retry(method, status):
+        """Whether a request failing with status (None when the
+        connection failed) is worth retrying."""
+        return method == 'GET' and (status is None or status >= 500 or
+                                    status == 429)
+
+    def get_backoff(self, attempt, deadline=None):
+        """Return the delay before retry attempt (0 based) or None.
+
+        None means that there are no retries left or that the retry
+        would start after deadline.
+        """
+        if attempt >= self.retries:
+            return None
+        delay = random.uniform(0, min(self.max_backoff,
+                                      self.backoff * 2 ** attempt))
+        if deadline and time.time() + delay >= deadline:
+            return None
+        return delay
+
+    def record_latency(self, latency):
+        with self._lock:
+            self._latencies.append(latency)
+            self._new_samples += 1
+            if (self._new_samples >= self.REFRESH or self._p95 is None) and \
+                    len(self._latencies) >= self.HEDGE_MIN_SAMPLES:
+                latencies = sorted(self._latencies)
+                self._p95 = latencies[int(0.95 * (len(latencies) - 1))]
+                self._new_samples = 0
+
+    def get_hedge_delay(self):
+        """Return the seconds after which a GET is sent again, or None."""
+        if not self.hedge:
+            return None
+        return self._p95
+
+
+class PrefixTrie(object):
+    """Binary radix trie of IPv4 and IPv6 prefixes.
+
+    A node is a [zero child, one child, values] list, the values of a
+    prefix are in the node reached by its bits.
+    """
+
+    WIDTHS = {socket.AF_INET: 32, socket.AF_INET6: 128}
+
+    def __init__(self):
+        self._roots = dict((family, [None, None, None])
+                           for family in self.WIDTHS)
+
+    @classmethod
+    def parse(cls, prefix):
+        """Return (family, bits, length) of an address or a CIDR."""
+        address, _, length = prefix.strip().partition('/')
+        family = socket.AF_INET6 if ':' in address else socket.AF_INET
+        width = cls.WIDTHS[family]
+        try:
+            bits = int(binascii.hexlify(socket.inet_pton(family, address)),
+                       16)
+            length = int(length) if length else width
+        except (socket.error, ValueError):
+            raise ValueError('Invalid address %s' % prefix)
+        if not 0 <= length <= width:
+            raise ValueError('Invalid prefix length %s' % prefix)
+        return family, bits, length
+
+    def _walk(self, family, bits, length, create=False):
+        """Yield the nodes on the path of a prefix, root first."""
+        node = self._roots[family]
+        width = self.WIDTHS[family]
+        yield node
+        for i in range(length):
+            bit = (bits >> (width - 1 - i)) & 1
+            if node[bit] is None:
+                if not create:
+                    return
+                node[bit] = [None, None, None]
+            node = node[bit]
+            yield node
+
+    def insert(self, prefix, value):
+        family, bits, length = self.parse(prefix)
+        for node in self._walk(family, bits, length, create=True):
+            pass
+        if node[2] is None:
+            node[2] = []
+        node[2].append(value)
+
+    def longest_match(self, address):
+        """Return the values of the longest prefix containing address."""
+        values = []
+        for node in self._walk(*self.parse(address)):
+            if node[2]:
+                values = node[2]
+        return values
+
+    def covering(self, prefix):
+        """Return the values of the prefixes containing prefix."""
+        values = []
+        for node in self._walk(*self.parse(prefix)):
+            values.extend(node[2] or [])
+        return values
+
+    def values(self):
+        """Return the values of all the prefixes."""
+        values = []
+        pending = list(self._roots.values())
+        while pending:
+            node = pending.pop()
+            values.extend(node[2] or [])
+            pending.extend(child for child in node[:2] if child)
+        return values
+
+    def overlapping(self, prefix):
+        """Return the values of the prefixes overlapping prefix.
+
+        Those are the prefixes containing it, on its path, and the ones
+        it contains, in the subtree below it.
+        """
+        family, bits, length = self.parse(prefix)
+        values = []
+        depth = -1
+        for depth, node in enumerate(self._walk(family, bits, length)):
+            values.extend(node[2] or [])
+        if depth < length:
+            return values
+
+        # node is the one of prefix, its values are already in
+        pending = [child for child in node[:2] if child]
+        while pending:
+            node = pending.pop()
+            values.extend(node[2] or [])
+            pending.extend(child for child in node[:2] if child)
+        return values
+
+
+class ContrailTopologySnapshot(object):
+    """SQLite copy of the virtual networks gathered by list.
+
+    The network infos are stored as JSON, their routing instances and
+    route targets in tables indexed on what the list filters look up.
+    """
+
+    SCHEMA = [
+        'CREATE TABLE snapshot (key TEXT PRIMARY KEY, value TEXT)',
+        'CREATE TABLE network (uuid TEXT PRIMARY KEY, fq_name TEXT, '
+        'tenant_id TEXT, info TEXT)',
+        'CREATE INDEX network_fq_name ON network (fq_name)',
+        'CREATE INDEX network_tenant_id ON network (tenant_id)',
+        'CREATE TABLE routing_instance (uuid TEXT PRIMARY KEY, '
+        'fq_name TEXT, network_uuid TEXT)',
+        'CREATE INDEX routing_instance_fq_name ON routing_instance '
+        '(fq_name)',
+        'CREATE TABLE route_target (target TEXT, uuid TEXT, fq_name TEXT, '
+        'direction TEXT, routing_instance_uuid TEXT)',
+        'CREATE INDEX route_target_target ON route_target (target)',
+    ]
+
+    def __init__(self, path):
+        if not os.path.isfile(path):
+            raise ContrailRouteHelperError('Snapshot %s not found' % path)
+        self._path = path
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def create(cls, path, vnets, server):
+        """Write vnets to a new snapshot at path, return their number."""
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        db = sqlite3.connect(tmp_path)
+        try:
+            for statement in cls.SCHEMA:
+                db.execute(statement)
+            count = 0
+            for vnet in vnets:
+                db.execute('INSERT INTO network VALUES (?, ?, ?, ?)',
+                           (vnet.uuid, ':'.join(vnet.fq_name),
+                            vnet.tenant_id, json.dumps(vnet.to_dict())))
+                for ri in vnet.routing_instances:
+                    db.execute('INSERT INTO routing_instance '
+                               'VALUES (?, ?, ?)',
+                               (ri.uuid, ':'.join(ri.fq_name), vnet.uuid))
+                    db.executemany(
+                        'INSERT INTO route_target VALUES (?, ?, ?, ?, ?)',
+                        [(rt.target, rt.uuid, json.dumps(rt.fq_name),
+                          direction, ri.uuid)
+                         for rt, direction in ri.route_targets])
+                count += 1
+            db.executemany('INSERT INTO snapshot VALUES (?, ?)',
+                           [('server', server), ('time', str(time.time())),
+                            ('networks', str(count))])
+            db.commit()
+        finally:
+            db.close()
+        os.rename(tmp_path, path)
+        return count
+
+    def _query(self, statement, args=()):
+        with self._lock:
+            return self._db.execute(statement, args).fetchall()
+
+    def iter_networks(self, tenant_id=None):
+        if tenant_id:
+            rows = self._query('SELECT info FROM network WHERE tenant_id = ? '
+                               'ORDER BY rowid',
+                               (tenant_id.replace('-', ''),))
+        else:
+            rows = self._query('SELECT info FROM network ORDER BY rowid')
+        for (info,) in rows:
+            yield json.loads(info)
+
+    def get_network(self, network):
+        """Return the info of the network with the uuid or fq_name."""
+        rows = self._query('SELECT info FROM network WHERE uuid = ? OR '
+                           'fq_name = ? LIMIT 1', (network, network))
+        return json.loads(rows[0][0]) if rows else None
+
+    def get_routing_instance_network(self, routing_instance):
+        """Return the uuid of the network of a routing instance."""
+        rows = self._query('SELECT network_uuid FROM routing_instance '
+                           'WHERE uuid = ? OR fq_name = ? LIMIT 1',
+                           (routing_instance, routing_instance))
+        return rows[0][0] if rows else None
+
+    def get_target_networks(self, target):
+        """Return the infos of the networks using target.
+
+        As for list --target, a network has the routing instances
+        referring to the target, with this route target only.
+        """
+        vnets = []
+        for info, ri_uuid, rt_uuid, rt_fq_name, direction in self._query(
+                'SELECT network.info, route_target.routing_instance_uuid, '
+                'route_target.uuid, route_target.fq_name, '
+                'route_target.direction FROM route_target '
+                'JOIN routing_instance ON routing_instance.uuid = '
+                'route_target.routing_instance_uuid '
+                'JOIN network ON network.uuid = routing_instance.network_uuid '
+                'WHERE route_target.target = ? ORDER BY route_target.rowid',
+                (target,)):
+            vnet = json.loads(info)
+            rt_info = {'fq_name': json.loads(rt_fq_name),
+                       'uuid': rt_uuid, 'target': target,
+                       'direction': direction}
+            vnet['routing_instances'] = [
+                dict(ri, route_targets=[rt_info])
+                for ri in vnet['routing_instances'] if ri['uuid'] == ri_uuid]
+            vnets.append(vnet)
+        return vnets
+
+
+class ContrailRouteHelperError(Exception):
+    """A command of ContrailRouteHelper failed.
+
+    status is the exit status of contrail_ri_util.py for the error.
+    """
+
+    def __init__(self, message, status=1):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+class ContrailRouteServer(SocketServer.ThreadingMixIn,
+                          SocketServer.UnixStreamServer):
+    """Unix socket server running the commands sent by its clients."""
+
+    daemon_threads = True
+
+    def __init__(self, path, helper):
+        # the socket gives access to the credentials of the helper
+        umask = os.umask(0o077)
+        try:
+            SocketServer.UnixStreamServer.__init__(
+                self, path, ContrailRouteRequestHandler)
+        finally:
+            os.umask(umask)
+        self.helper = helper
+
+
+class ContrailRouteRequestHandler(SocketServer.StreamRequestHandler):
+    """Read JSON requests, one per line, and write a JSON line for each."""
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+                response = self.server.helper.serve_request(request)
+            except ValueError as e:
+                response = {'error': 'Invalid request : %s' % e, 'status': 1}
+            self.wfile.write('%s\n' % json.dumps(response))
+            self.wfile.flush()
+
+
+class _CallResult(object):
+    """Already available result with the interface of an AsyncResult."""
+
+    def __init__(self, value):
+        self._value = value
+
+    def get(self):
+        return self._value
 
 
 class ContrailRouteHelper(object):
 
+    # number of uuids sent in a single bulk listing query
+    BULK_QUERY_SIZE = 100
+    # number of networks list resolves before printing them
+    LIST_CHUNK_SIZE = 100
+    # bounds in seconds of the interval between two readiness polls
+    POLL_MIN_INTERVAL = 0.05
+    POLL_MAX_INTERVAL = 1.0
+    # route targets created before giving up on finding an unused one
+    RT_ALLOCATION_ATTEMPTS = 10
+    # commands a batch manifest can run
+    BATCH_OPERATIONS = ('enable-routing', 'disable-routing',
+                        'add-route-target', 'remove-route-target')
+    # operation arguments naming a network
+    BATCH_NETWORK_ARGS = ('network', 'left_network', 'right_network')
+
     def __init__(self, args_str=None):
+        """Parse args_str, a command line string or a list of arguments.
+
+        Without a command (only the global options), the helper is used
+        as a library: the commands are given to run().
+        """
         self._args = None
-        if not args_str:
-            args_str = ' '.join(sys.argv[1:])
-        self._parse_args(args_str)
+        self._parse_args(self._split_args(args_str))
+        self._snapshot = None
+        if self._args.offline:
+            self._snapshot = ContrailTopologySnapshot(self._args.offline)
         if self._args.auth_token:
             self.base_curl_cmd = ('curl -H X-Auth-Token:%s'
                                   % (self._args.auth_token))
         else:
-            if self._args.username is None or self._args.password is None:
-                print ('Either username/password or auth token is required')
-                sys.exit(1)
+            if not self._snapshot and (self._args.username is None or
+                                       self._args.password is None):
+                raise ContrailRouteHelperError(
+                    'Either username/password or auth token is required')
 
             self.base_curl_cmd = ('curl -u %s:%s ' % (self._args.username,
                                                       self._args.password))
         self.base_url = ('http://%s:%s' % (self._args.api_server,
                                            self._args.api_port))
-
-    def _parse_args(self, args_str):
+        self._http_headers = self._get_http_headers()
+        self._connection_pools = {}
+        self._worker_pool = None
+        self._object_cache = ContrailObjectCache(self._args.cache_size)
+        self._model = ContrailModelBuilder()
+        self._trace = None
+        if self._args.profile or self._args.trace_file:
+            self._trace = ContrailRequestTrace()
+        self._request_policy = ContrailRequestPolicy(
+            retries=self._args.retries, backoff=self._args.retry_backoff,
+            hedge=self._args.hedge)
+        self._hedge_pool = None
+        self._deadline = None
+        self._rt_allocator = RouteTargetAllocator()
+        self._fqname_cache = ContrailFqNameCache(
+            self._args.fqname_cache_file,
+            '%s:%s' % (self._args.api_server, self._args.api_port),
+            self._args.fqname_cache_ttl, self._args.fqname_cache_size)
+        atexit.register(self._fqname_cache.save)
+        self._lock = threading.Lock()
+        self._print_lock = threading.Lock()
+        # print the API requests and the resulting networks, the requests
+        # would corrupt the JSON output formats
+        self._verbose = self._args.format == 'text'
+        self._quiet = False
+
+    def _get_http_headers(self):
+        headers = {'Accept': 'application/json'}
+        if self._args.auth_token:
+            headers['X-Auth-Token'] = self._args.auth_token
+        else:
+            credentials = '%s:%s' % (self._args.username, self._args.password)
+            headers['Authorization'] = ('Basic %s'
+                                        % base64.b64encode(credentials))
+        return headers
+
+    @staticmethod
+    def _split_args(args_str):
+        if args_str is None:
+            return sys.argv[1:]
+        if isinstance(args_str, basestring):
+            return shlex.split(args_str)
+        return list(args_str)
+
+    def _parse_args(self, argv):
+        # -h is added with the commands, a help request must not be taken
+        # for a library use without command
         parser = argparse.ArgumentParser(description='OpenContrail Routing'
-                                         ' Instance Helper')
+                                         ' Instance Helper', add_help=False)
 
         parser.add_argument("-U", "--username", required=False,
                             help="Username of the tenant")
@@ -50,7 +1231,82 @@ class ContrailRouteHelper(object):
                             type=bool,
                             default=True,
                             help="Output the curl json response")
-
+        parser.add_argument("-f", "--format",
+                            choices=['text', 'json', 'jsonl'],
+                            default='text',
+                            help="Output format of the virtual networks, "
+                            "jsonl prints one JSON object per line as soon "
+                            "as each network is resolved")
+        parser.add_argument("--transport", choices=['http', 'curl'],
+                            default='http',
+                            help="Use the in-process keep-alive HTTP client "
+                            "(default) or spawn a curl process per request")
+        parser.add_argument("--pool-size", type=int, default=None,
+                            help="Maximum number of keep-alive connections "
+                            "to the API server (default: --concurrency)")
+        parser.add_argument("--concurrency", type=int, default=8,
+                            help="Maximum number of API requests in flight "
+                            "while fetching networks, routing instances and "
+                            "route targets")
+        parser.add_argument("--bulk", action='store_true',
+                            help="Read networks, routing instances and route "
+                            "targets with a few detail listings instead of "
+                            "one request per object")
+        parser.add_argument("--page-size", type=int, default=0,
+                            help="List the virtual networks in pages of "
+                            "this many networks (default: a single listing)")
+        parser.add_argument("--cache-size", type=int, default=10000,
+                            help="Maximum number of API responses kept in "
+                            "the in-memory cache (0 disables it)")
+        parser.add_argument("--fqname-cache-file",
+                            default=os.path.join(
+                                os.environ.get('XDG_CACHE_HOME',
+                                               os.path.expanduser('~/.cache')),
+                                'contrail_ri_util', 'fqname-to-id.json'),
+                            help="File caching fq_name to uuid resolutions "
+                            "across runs")
+        parser.add_argument("--fqname-cache-ttl", type=int, default=600,
+                            help="Seconds a cached fq_name to uuid "
+                            "resolution is used (0 disables the cache)")
+        parser.add_argument("--fqname-cache-size", type=int, default=10000,
+                            help="Maximum number of resolutions kept in the "
+                            "fq_name cache file")
+        parser.add_argument("--http-timeout", type=float, default=60,
+                            help="Socket timeout in seconds for API requests")
+        parser.add_argument("--offline", metavar='SNAPSHOT',
+                            help="Answer the read-only commands from a "
+                            "snapshot written by the snapshot command "
+                            "instead of the API server")
+        parser.add_argument("--deadline", type=float, default=0,
+                            help="Seconds a command may run, its API "
+                            "requests fail afterwards (0: no deadline)")
+        parser.add_argument("--retries", type=int, default=3,
+                            help="Times a GET failing with a connection "
+                            "error or a 5xx/429 status is retried")
+        parser.add_argument("--retry-backoff", type=float, default=0.1,
+                            help="Base in seconds of the jittered "
+                            "exponential backoff between the retries")
+        parser.add_argument("--hedge", action='store_true',
+                            help="Send a GET a second time when it is not "
+                            "answered within the p95 latency of the "
+                            "previous GETs, and use the first answer")
+        parser.add_argument("--profile", action='store_true',
+                            help="Print the number of API requests and "
+                            "their latency percentiles per endpoint, and "
+                            "the slowest requests, to stderr at the end")
+        parser.add_argument("--profile-slowest", type=int, default=10,
+                            help="Number of slowest requests --profile "
+                            "prints")
+        parser.add_argument("--trace-file",
+                            help="Write every API request (method, path, "
+                            "latency, response size, cache hit or miss) to "
+                            "this file as JSON at the end")
+
+        global_args, command_argv = parser.parse_known_args(argv)
+        self._global_options = sorted(vars(global_args))
+
+        parser.add_argument('-h', '--help', action='help',
+                            help='show this help message and exit')
         subparsers = parser.add_subparsers()
         list_parser = subparsers.add_parser(
             'list', help='list all the virtual networks with '
@@ -108,11 +1364,40 @@ class ContrailRouteHelper(object):
             help='Routing instance name')
         disable_routing_parser.add_argument(
             '--target',
-            required=True,
-            help='route target in the format <asn>:<target_number>')
+            required=False,
+            help='route target in the format <asn>:<target_number>, by '
+            'default the route target shared by the two networks only')
 
         disable_routing_parser.set_defaults(func=self.disable_routing)
 
+        connectivity_parser = subparsers.add_parser(
+            'connectivity',
+            help='Group the virtual networks exchanging routes through '
+            'their route targets')
+        connectivity_parser.add_argument(
+            '--network',
+            help='network id or network fq_name, show the networks it '
+            'imports routes from and exports routes to instead')
+        connectivity_parser.set_defaults(func=self.show_connectivity)
+
+        find_ip_parser = subparsers.add_parser(
+            'find-ip',
+            help='Find the virtual network and routing instance owning IP '
+            'addresses by longest prefix match on the subnets')
+        find_ip_parser.add_argument(
+            'addresses', nargs='*',
+            help='IPv4 or IPv6 addresses, read one per line from stdin '
+            'when none is given')
+        find_ip_parser.set_defaults(func=self.find_ip)
+
+        overlaps_parser = subparsers.add_parser(
+            'overlaps',
+            help='List the subnets overlapping a CIDR, or all the '
+            'overlapping subnets of different networks')
+        overlaps_parser.add_argument('cidr', nargs='?',
+                                     help='IPv4 or IPv6 CIDR')
+        overlaps_parser.set_defaults(func=self.find_overlaps)
+
         add_route_target = subparsers.add_parser(
             'add-route-target',
             help='Add a route target to the virtual network')
@@ -147,9 +1432,161 @@ class ContrailRouteHelper(object):
         remove_route_target.add_argument(
             '--network',
             help='network id or network fq_name of the virtual network')
+        remove_route_target.add_argument(
+            '--delete-timeout', type=float, default=10,
+            help='Seconds to wait for the routing instance to release the '
+            'route target before deleting it')
         remove_route_target.set_defaults(func=self.remove_route_target)
 
-        self._args = parser.parse_args()
+        batch_parser = subparsers.add_parser(
+            'batch',
+            help='Run the enable-routing, disable-routing, add-route-target '
+            'and remove-route-target operations listed in a manifest')
+        batch_parser.add_argument(
+            'manifest',
+            help='JSON-lines (or YAML) file with one operation per entry, '
+            'e.g. {"operation": "enable-routing", "left-network": ..., '
+            '"right-network": ..., "target": ...}. - reads stdin. The '
+            '.yaml or .yml extension, or else a first entry that is not '
+            'a JSON object, selects YAML')
+        batch_parser.add_argument(
+            '--workers', type=int, default=4,
+            help='Number of independent operations run concurrently')
+        batch_parser.set_defaults(func=self.batch)
+
+        snapshot_parser = subparsers.add_parser(
+            'snapshot',
+            help='Save the virtual networks, routing instances and route '
+            'targets list gathers to a SQLite file, see --offline')
+        snapshot_parser.add_argument('snapshot_file',
+                                     help='Path of the snapshot to write')
+        snapshot_parser.set_defaults(func=self.save_snapshot)
+
+        watch_parser = subparsers.add_parser(
+            'watch',
+            help='Print the route target changes of the virtual networks, '
+            'reading again only the networks whose objects changed')
+        watch_parser.add_argument(
+            '--interval', type=float, default=60,
+            help='Seconds between two polls of the modification times')
+        watch_parser.add_argument(
+            '--count', type=int, default=0,
+            help='Number of polls, 0 polls until interrupted')
+        watch_parser.set_defaults(func=self.watch)
+
+        serve_parser = subparsers.add_parser(
+            'serve',
+            help='Run the commands sent as JSON lines to a unix socket, '
+            'keeping the connections and caches warm between them')
+        serve_parser.add_argument(
+            '--socket',
+            default=os.path.join(
+                os.environ.get('XDG_RUNTIME_DIR',
+                               os.path.join(os.environ.get(
+                                   'XDG_CACHE_HOME',
+                                   os.path.expanduser('~/.cache')),
+                                   'contrail_ri_util')),
+                'contrail_ri_util.sock'),
+            help='Path of the unix socket')
+        serve_parser.add_argument(
+            '--cache-ttl', type=float, default=10,
+            help='Seconds an API response is served from the cache (0 '
+            'keeps it until a write invalidates it)')
+        serve_parser.set_defaults(func=self.serve)
+
+        self._parser = parser
+        self._command_parsers = {
+            'list': list_parser,
+            'show': show_parser,
+            'enable-routing': enable_routing_parser,
+            'disable-routing': disable_routing_parser,
+            'connectivity': connectivity_parser,
+            'find-ip': find_ip_parser,
+            'overlaps': overlaps_parser,
+            'add-route-target': add_route_target,
+            'remove-route-target': remove_route_target,
+            'snapshot': snapshot_parser,
+            'watch': watch_parser,
+            'batch': batch_parser}
+
+        if command_argv:
+            self._args = parser.parse_args(argv)
+        else:
+            self._args = global_args
+
+    def _get_global_args(self):
+        return argparse.Namespace(**dict(
+            (option, getattr(self._args, option))
+            for option in self._global_options))
+
+    def _get_command_helper(self, args):
+        """Return a copy of this helper running the command of args.
+
+        The copy shares the connections, caches and worker threads and
+        returns its results instead of printing them.
+        """
+        if self._args.concurrency > 1:
+            self._get_worker_pool()
+        helper = copy.copy(self)
+        helper._args = args
+        helper._model = ContrailModelBuilder()
+        helper._verbose = False
+        helper._quiet = True
+        return helper
+
+    def run(self, args_str):
+        """Run a command and return its result.
+
+        args_str is the command and its arguments, as a string or a
+        list, e.g. 'show <network>'. The global options are those of
+        this helper. list, show and the routing commands return the
+        resulting virtual networks, batch the result of every operation.
+        Raises ContrailRouteHelperError if the command fails.
+        """
+        argv = self._split_args(args_str)
+        if not argv or argv[0] not in self._command_parsers:
+            raise ContrailRouteHelperError(
+                'Unknown command %s' % (argv[0] if argv else ''))
+        try:
+            args = self._command_parsers[argv[0]].parse_args(
+                argv[1:], namespace=self._get_global_args())
+        except SystemExit:
+            raise ContrailRouteHelperError('Invalid arguments %s'
+                                           % ' '.join(argv))
+        helper = self._get_command_helper(args)
+        helper._start_deadline()
+        return getattr(helper, args.func.__name__)()
+
+    def _get_message_output(self):
+        """Return the file the messages are printed to.
+
+        With a JSON --format stdout only carries the result, the
+        messages go to stderr.
+        """
+        return sys.stdout if self._args.format == 'text' else sys.stderr
+
+    def _print(self, message):
+        if not self._quiet:
+            print >>self._get_message_output(), message
+
+    def _start_deadline(self):
+        """Start the --deadline of a command."""
+        self._deadline = None
+        if self._args.deadline:
+            self._deadline = time.time() + self._args.deadline
+
+    def report_trace(self):
+        """Print the --profile summary and write the --trace-file."""
+        if not self._trace:
+            return
+        if self._args.profile:
+            self._trace.print_summary(sys.stderr, self._args.profile_slowest)
+        if self._args.trace_file:
+            try:
+                self._trace.save(self._args.trace_file)
+            except IOError as e:
+                print ('Failed to write the trace %s : %s'
+                       % (self._args.trace_file, e))
 
     def _execute_curl_cmd(self, cmd, json_data=None, verbose=True):
         args = cmd.split()
@@ -157,61 +1594,403 @@ class ContrailRouteHelper(object):
             json_data = json.JSONEncoder().encode(json_data)
             args.append(json_data)
         if verbose:
-            print '\n'
-            print ('Executing curl command ')
-            if json_data:
-                print ('%s%s' % (cmd, json_data))
-            else:
-                print cmd
-            print '\n'
+            with self._print_lock:
+                print '\n'
+                print ('Executing curl command ')
+                if json_data:
+                    print ('%s%s' % (cmd, json_data))
+                else:
+                    print cmd
+                print '\n'
 
+        # the status is written after the body, to tell an empty response
+        # of a successful DELETE from an error
+        args[1:1] = ['-w', '\n%{http_code}']
         process = subprocess.Popen(args, shell=False, stdout=subprocess.PIPE,
                                    stderr=subprocess.PIPE)
         stdout, stderr = process.communicate()
+        stdout, _, status = stdout.rpartition('\n')
+        if self._trace:
+            self._trace.set_response_size(len(stdout))
+        if not status.isdigit() or not 200 <= int(status) < 300:
+            out = self._get_message_output()
+            print >>out, ('Returned error response from server :  %s %s'
+                          % (status, stdout))
+            print >>out, stderr
+            return None
+        if not stdout:
+            return {}
         try:
             json_response = json.loads(stdout)
             if verbose and self._args.output_json:
-                print ('Response : ', json_response)
-                print '\n'
+                with self._print_lock:
+                    print ('Response : ', json_response)
+                    print '\n'
         except:
-            print 'Returned error response from server : ', stdout
-            print stderr
+            out = self._get_message_output()
+            print >>out, 'Returned error response from server : ', stdout
+            print >>out, stderr
+            return None
+
+        return json_response
+
+    def _get_curl_cmd(self, method, url):
+        if method == 'GET':
+            return '%s -s %s' % (self.base_curl_cmd, url)
+        if method == 'POST':
+            return ('%s -X POST %s -H Content-Type:application/json -d '
+                    % (self.base_curl_cmd, url))
+        return '%s -X %s %s' % (self.base_curl_cmd, method, url)
+
+    def _get_connection_pool(self, host, port):
+        key = (host, port)
+        with self._lock:
+            pool = self._connection_pools.get(key)
+            if not pool:
+                pool_size = (self._args.pool_size or
+                             max(self._args.concurrency, 1))
+                if self._args.hedge and not self._args.pool_size:
+                    # room for the duplicated requests
+                    pool_size *= 2
+                pool = ContrailApiConnectionPool(
+                    host, port, self._http_headers, pool_size=pool_size,
+                    timeout=self._args.http_timeout)
+                self._connection_pools[key] = pool
+        return pool
+
+    def _execute_http_request(self, method, url, json_data=None,
+                              verbose=True):
+        body = None
+        if json_data:
+            body = json.JSONEncoder().encode(json_data)
+        if verbose:
+            with self._print_lock:
+                print '\n'
+                print ('Executing request ')
+                print ('%s %s %s' % (method, url, body or ''))
+                print '\n'
+
+        parsed_url = urlparse.urlsplit(url)
+        path = parsed_url.path
+        if parsed_url.query:
+            path = '%s?%s' % (path, parsed_url.query)
+        pool = self._get_connection_pool(parsed_url.hostname,
+                                         parsed_url.port or 80)
+        policy = self._request_policy
+        attempt = 0
+        while True:
+            start = time.time()
+            status = error = None
+            try:
+                hedge_delay = policy.get_hedge_delay()
+                if method == 'GET' and hedge_delay is not None:
+                    status, data = self._hedged_request(
+                        pool, method, path, body, hedge_delay)
+                else:
+                    status, data = pool.request(
+                        method, path, body, timeout=self._get_timeout())
+            except (httplib.HTTPException, socket.error) as e:
+                error = e
+            if method == 'GET' and status is not None and status < 500:
+                policy.record_latency(time.time() - start)
+            if not policy.should_retry(method, status):
+                break
+            delay = policy.get_backoff(attempt, self._deadline)
+            if delay is None:
+                break
+            attempt += 1
+            time.sleep(delay)
+
+        if error:
+            out = self._get_message_output()
+            print >>out, 'Request %s %s failed : %s' % (method, url, error)
+            return None
+        if self._trace:
+            self._trace.set_response_size(len(data))
+
+        if status >= 400:
+            out = self._get_message_output()
+            print >>out, 'Returned error response from server : ', status, data
+            return None
+        if not data:
+            return {}
+        try:
+            json_response = json.loads(data)
+            if verbose and self._args.output_json:
+                with self._print_lock:
+                    print ('Response : ', json_response)
+                    print '\n'
+        except ValueError:
+            out = self._get_message_output()
+            print >>out, 'Returned error response from server : ', data
             return None
 
         return json_response
 
+    def _get_timeout(self):
+        """Return the socket timeout of a request, bound by the deadline."""
+        if not self._deadline:
+            return None
+        remaining = self._deadline - time.time()
+        if remaining <= 0:
+            raise ContrailRouteHelperError(
+                'Deadline of %ss exceeded' % self._args.deadline)
+        return min(remaining, self._args.http_timeout)
+
+    def _hedged_request(self, pool, method, path, body, hedge_delay):
+        """Send a request, and again if it takes longer than hedge_delay.
+
+        Returns the first successful (status, data), or raises the error
+        of the last request.
+        """
+        timeout = self._get_timeout()
+        results = Queue.Queue()
+
+        def _send():
+            try:
+                results.put((pool.request(method, path, body,
+                                          timeout=timeout), None))
+            except (httplib.HTTPException, socket.error) as e:
+                results.put((None, e))
+
+        with self._lock:
+            if not self._hedge_pool:
+                self._hedge_pool = ThreadPool(
+                    2 * max(self._args.concurrency, 1))
+        self._hedge_pool.apply_async(_send)
+        try:
+            response, error = results.get(timeout=hedge_delay)
+            pending = 0
+        except Queue.Empty:
+            self._hedge_pool.apply_async(_send)
+            response, error = results.get()
+            pending = 1
+        # a failed request waits for the answer of the other one
+        if pending and (error or response[0] >= 500):
+            response, error = results.get()
+        if error:
+            raise error
+        return response
+
+    def _api_request(self, method, url, json_data=None, verbose=True,
+                     use_cache=True):
+        if self._snapshot:
+            raise ContrailRouteHelperError(
+                'Only the read-only commands can run with --offline')
+        if self._deadline and time.time() >= self._deadline:
+            raise ContrailRouteHelperError(
+                'Deadline of %ss exceeded' % self._args.deadline)
+        parsed_url = urlparse.urlsplit(url)
+        cache_key = parsed_url.path
+        if parsed_url.query:
+            cache_key = '%s?%s' % (cache_key, parsed_url.query)
+        verbose = verbose and self._verbose
+
+        def _send_request():
+            if self._args.transport == 'curl':
+                return self._execute_curl_cmd(
+                    self._get_curl_cmd(method, url), json_data=json_data,
+                    verbose=verbose)
+            return self._execute_http_request(
+                method, url, json_data=json_data, verbose=verbose)
+
+        start = time.time()
+        cache = None
+        if method == 'GET' and use_cache:
+            misses = []
+
+            def _fetch():
+                misses.append(cache_key)
+                return _send_request()
+
+            response = self._object_cache.get_or_fetch(cache_key, _fetch)
+            cache = 'miss' if misses else 'hit'
+        else:
+            response = _send_request()
+        if self._trace:
+            self._trace.record(method, cache_key, start, cache=cache,
+                               failed=response is None)
+
+        if method != 'GET' and cache_key != '/fqname-to-id':
+            self._invalidate_cache(method, cache_key, json_data, response)
+        return response
+
+    def _invalidate_cache(self, method, path, json_data, response):
+        obj_uuids = []
+        if method == 'DELETE':
+            obj_uuids.append(path.rsplit('/', 1)[-1])
+        elif path == '/ref-update':
+            obj_uuids.extend([json_data.get('uuid'),
+                              json_data.get('ref-uuid')])
+        elif response:
+            # the parent of a created object has a new child
+            for obj in response.values():
+                if isinstance(obj, dict):
+                    obj_uuids.extend([obj.get('uuid'),
+                                      obj.get('parent_uuid')])
+        self._object_cache.invalidate(obj_uuids)
+
+    def _get_worker_pool(self):
+        with self._lock:
+            if not self._worker_pool:
+                self._worker_pool = ThreadPool(self._args.concurrency)
+        return self._worker_pool
+
+    def _fetch_all(self, func, items):
+        """Apply func to every item, concurrently when allowed.
+
+        The results are returned in the order of items. At most
+        --concurrency calls are in flight at a time.
+        """
+        items = list(items)
+        if self._args.concurrency <= 1 or len(items) <= 1:
+            return [func(item) for item in items]
+        return self._get_worker_pool().map(func, items, chunksize=1)
+
+    def _fetch_async(self, func, *args):
+        """Start func(*args) in the worker pool.
+
+        The returned result's get() waits for and returns the value of
+        the call. Without concurrency func is called right away.
+        """
+        if self._args.concurrency > 1:
+            return self._get_worker_pool().apply_async(func, args)
+        return _CallResult(func(*args))
+
+    def _get_object(self, href):
+        return self._api_request('GET', href)
+
     def _extract_routing_instances(self, vnet):
-        ris = []
-        for ri in vnet['routing_instances']:
-            ri_cmd = ('%s -s %s' % (self.base_curl_cmd, ri['href']))
-            route_instance = self._execute_curl_cmd(ri_cmd)
+        return self._extract_all_routing_instances([vnet])[0]
+
+    def _list_objects(self, res_type, query=None, use_cache=True):
+        url = '%s/%ss' % (self.base_url, res_type)
+        if query:
+            url = '%s?%s' % (url, urllib.urlencode(sorted(query.items())))
+        return self._api_request('GET', url, use_cache=use_cache)
+
+    def _iter_list_pages(self, res_type, query, use_cache=True):
+        """Yield the objects of a listing one page at a time.
+
+        Without --page-size the whole listing is a single page. Otherwise
+        the next page is requested while the caller processes the
+        current one. A None page is yielded when a listing fails.
+        """
+        if not self._args.page_size:
+            response = self._list_objects(res_type, query,
+                                          use_cache=use_cache)
+            yield response['%ss' % res_type] if response else None
+            return
+
+        def _get_page(marker):
+            page_query = dict(query, page_limit=self._args.page_size)
+            if marker:
+                page_query['page_marker'] = marker
+            return self._list_objects(res_type, page_query, use_cache=False)
+
+        pending = self._fetch_async(_get_page, None)
+        while pending:
+            response = pending.get()
+            if not response:
+                yield None
+                return
+            objs = response['%ss' % res_type]
+            marker = response.get('marker')
+            pending = None
+            if marker and objs:
+                pending = self._fetch_async(_get_page, marker)
+            yield objs
+
+    def _bulk_list_objects(self, res_type, filter_name, values, fields=None):
+        """Read the detail of every object matching one of values.
+
+        The values (uuids) are sent BULK_QUERY_SIZE at a time in the
+        filter_name query parameter of a detail listing.
+        """
+        values = list(values)
+        queries = []
+        for i in range(0, len(values), self.BULK_QUERY_SIZE):
+            query = {'detail': 'true',
+                     filter_name: ','.join(values[i:i + self.BULK_QUERY_SIZE])}
+            if fields:
+                query['fields'] = ','.join(fields)
+            queries.append(query)
+
+        objs = []
+        for response in self._fetch_all(
+                lambda query: self._list_objects(res_type, query), queries):
+            if not response:
+                continue
+            objs.extend(obj[res_type]
+                        for obj in response['%ss' % res_type])
+        return objs
+
+    def _extract_all_routing_instances(self, vnets):
+        # fetch one level of the VN -> RI -> RT tree at a time, either
+        # with one GET per object issued concurrently or with a few bulk
+        # listings, and join the levels by uuid
+        ri_refs = [ri for vnet in vnets
+                   for ri in vnet.get('routing_instances', [])]
+        if self._args.bulk:
+            route_instances = self._bulk_list_objects(
+                'routing-instance', 'parent_id',
+                [vnet['uuid'] for vnet in vnets
+                 if vnet.get('routing_instances')],
+                fields=['route_target_refs'])
+        else:
+            route_instances = [
+                ri['routing-instance'] for ri in
+                self._fetch_all(self._get_object,
+                                [ri['href'] for ri in ri_refs]) if ri]
+        route_instances = dict((ri['uuid'], ri) for ri in route_instances)
+
+        rt_refs = {}
+        for ri in ri_refs:
+            route_instance = route_instances.get(ri['uuid'])
             if not route_instance:
                 continue
-
-            route_instance = route_instance['routing-instance']
-            ri_info = {'fq_name': route_instance['fq_name'],
-                       'uuid': route_instance['uuid'],
-                       'route_targets': []}
             for rt in route_instance.get('route_target_refs', []):
-                rt_cmd = ('%s -s %s' % (self.base_curl_cmd,
-                                        rt['href']))
-                route_target = self._execute_curl_cmd(rt_cmd)
-                if not route_target:
+                rt_refs.setdefault(rt['uuid'], rt['href'])
+        rt_uuids = sorted(rt_refs)
+        if self._args.bulk:
+            route_targets = self._bulk_list_objects('route-target',
+                                                    'obj_uuids', rt_uuids)
+        else:
+            route_targets = [
+                rt['route-target'] for rt in
+                self._fetch_all(self._get_object,
+                                [rt_refs[rt_uuid] for rt_uuid in rt_uuids])
+                if rt]
+        # keep only the model of the route targets, not the responses
+        route_targets = dict(
+            (rt['uuid'], self._model.route_target(rt['uuid'], rt['fq_name'],
+                                                  rt['name']))
+            for rt in route_targets)
+
+        vnets_ris = []
+        for vnet in vnets:
+            ris = []
+            for ri in vnet.get('routing_instances', []):
+                route_instance = route_instances.get(ri['uuid'])
+                if not route_instance:
                     continue
 
-                try:
-                    direction = rt['attr']['import_export']
-                except:
-                    direction = None
-
-                route_target = route_target['route-target']
-                rt_info = {'fq_name': route_target['fq_name'],
-                           'uuid': route_target['uuid'],
-                           'target': route_target['name'],
-                           'direction': direction}
-                ri_info['route_targets'].append(rt_info)
-            ris.append(ri_info)
-        return ris
+                ri_targets = []
+                for rt in route_instance.get('route_target_refs', []):
+                    route_target = route_targets.get(rt['uuid'])
+                    if not route_target:
+                        continue
+
+                    try:
+                        direction = rt['attr']['import_export']
+                    except:
+                        direction = None
+                    ri_targets.append((route_target, direction))
+                ris.append(self._model.routing_instance(
+                    route_instance['uuid'], route_instance['fq_name'],
+                    ri_targets))
+            vnets_ris.append(ris)
+        return vnets_ris
 
     def _get_route_target_vns(self, target):
         if target.find('target') == 0:
@@ -219,54 +1998,71 @@ class ContrailRouteHelper(object):
         else:
             rt_key = ['target:%s' % (target)]
 
+        if self._snapshot:
+            vns = self._snapshot.get_target_networks(rt_key[0])
+            if not vns:
+                raise ContrailRouteHelperError('Route target : %s NOT FOUND '
+                                               % (target))
+            return self._print_virtual_networks(
+                [self._model.virtual_network_from_dict(vnet_info)
+                 for vnet_info in vns])
+
         rt_target = self._get_route_target(rt_key)
         if not rt_target:
-            print('Route target : %s NOT FOUND ' % (target))
-            sys.exit(1)
+            raise ContrailRouteHelperError('Route target : %s NOT FOUND '
+                                           % (target))
 
         vns = []
-        rt_info = {'fq_name': rt_target['fq_name'],
-                   'uuid': rt_target['uuid'],
-                   'target': rt_target['name']}
-        for ri in rt_target['routing_instance_back_refs']:
-            ri_cmd = ('%s -s %s' % (self.base_curl_cmd, ri['href']))
-            route_instance = self._execute_curl_cmd(ri_cmd)
-            if not route_instance:
-                continue
-            route_instance = route_instance['routing-instance']
-            ri_info = {'fq_name': route_instance['fq_name'],
-                       'uuid': route_instance['uuid'],
-                       'route_targets': [rt_info]}
-            vn_cmd = ('%s -s %s' % (self.base_curl_cmd,
-                                    route_instance['parent_href']))
-            vnet = self._execute_curl_cmd(vn_cmd)
+        back_refs = rt_target.get('routing_instance_back_refs', [])
+        route_instances = self._fetch_all(self._get_object,
+                                          [ri['href'] for ri in back_refs])
+        back_refs = [(ri, route_instance['routing-instance'])
+                     for ri, route_instance in zip(back_refs,
+                                                   route_instances)
+                     if route_instance]
+        vnets = self._fetch_all(
+            self._get_object,
+            [route_instance['parent_href'] for _, route_instance in back_refs])
+        route_target = self._model.route_target(
+            rt_target['uuid'], rt_target['fq_name'], rt_target['name'])
+        for (ri, route_instance), vnet in zip(back_refs, vnets):
             if not vnet:
                 continue
+            try:
+                direction = ri['attr']['import_export']
+            except:
+                direction = None
+            ri_info = self._model.routing_instance(
+                route_instance['uuid'], route_instance['fq_name'],
+                [(route_target, direction)])
             vnet = vnet['virtual-network']
             tenant_id = vnet['parent_uuid'].replace("-", "")
-            vnet_info = {'uuid': vnet['uuid'],
-                         'fq_name': vnet['fq_name'],
-                         'tenant_id': tenant_id}
-            subnets = self._get_vnet_subnets(vnet)
-            vnet_info['subnets'] = subnets
-            vnet_info['routing_instances'] = [ri_info]
-            vns.append(vnet_info)
+            vns.append(self._model.virtual_network(
+                vnet['uuid'], vnet['fq_name'], tenant_id,
+                self._get_vnet_subnets(vnet), [ri_info]))
 
-        self._print_virtual_networks(vns)
+        return self._print_virtual_networks(vns)
 
     def _get_vnet_subnets(self, vnet):
         subnets = []
         for ipam_refs in vnet.get('network_ipam_refs', []):
             attr = ipam_refs['attr']
             for ipam_subnet in attr['ipam_subnets']:
-                subnet_info = {
-                    'subnet_uuid': ipam_subnet['subnet_uuid'],
-                    'cidr': '%s/%s' % (ipam_subnet['subnet']['ip_prefix'],
-                                       ipam_subnet['subnet']['ip_prefix_len'])}
-                subnets.append(subnet_info)
-        return subnets
+                subnets.append(Subnet(
+                    ipam_subnet['subnet_uuid'],
+                    '%s/%s' % (ipam_subnet['subnet']['ip_prefix'],
+                               ipam_subnet['subnet']['ip_prefix_len'])))
+        return tuple(subnets)
 
     def _get_routing_instance_vns(self, ri_name):
+        if self._snapshot:
+            self._args.network_id = (
+                self._snapshot.get_routing_instance_network(ri_name))
+            if not self._args.network_id:
+                raise ContrailRouteHelperError(
+                    'Routing instance %s not found ' % ri_name)
+            return self.show_virtual_network()
+
         try:
             ri_uuid = uuid.UUID(ri_name)
             fq_name = None
@@ -278,38 +2074,68 @@ class ContrailRouteHelper(object):
                                                     fq_name=fq_name)
 
         self._args.network_id = route_instance['parent_uuid']
-        self.show_virtual_network()
+        return self.show_virtual_network()
 
     def list_virtual_networks(self):
         if self._args.target:
-            self._get_route_target_vns(self._args.target)
-            return
+            return self._get_route_target_vns(self._args.target)
 
         if self._args.routing_instance:
-            self._get_routing_instance_vns(self._args.routing_instance)
-            return
+            return self._get_routing_instance_vns(
+                self._args.routing_instance)
 
-        vns_cmd = ('%s -s http://%s:%s/virtual-networks'
-                   % (self.base_curl_cmd, self._args.api_server,
-                      self._args.api_port))
+        return self._print_virtual_networks(self._iter_virtual_networks())
+
+    def _iter_virtual_networks(self):
+        """Return an iterator of the networks, complete one at a time.
+
+        The networks are listed a page at a time and resolved
+        LIST_CHUNK_SIZE at a time so that only one chunk of the topology
+        is held in memory. The first page is read before returning, so
+        that the callers can fail before printing anything.
+
+        Raises ContrailRouteHelperError if a page can't be listed.
+        """
+        if self._snapshot:
+            return (self._model.virtual_network_from_dict(vnet_info)
+                    for vnet_info in self._snapshot.iter_networks(
+                        self._args.tenant_id))
+
+        query = {}
         if self._args.tenant_id:
             try:
-                parent_id = str(uuid.UUID(self._args.tenant_id))
-                parent_id_str = '?parent_id=%s' % (parent_id)
-                vns_cmd = ('%s%s' % (vns_cmd, parent_id_str))
+                query['parent_id'] = str(uuid.UUID(self._args.tenant_id))
             except:
                 pass
-
-        virtual_nets = self._execute_curl_cmd(vns_cmd)
-        if not virtual_nets:
-            print ('Virtual networks couldnt be retrieved\n')
-            return
-
-        total_virtual_nets = []
-        for vn in virtual_nets['virtual-networks']:
-            # get details about the virtual-network
-            vn_cmd = ('%s -s %s' % (self.base_curl_cmd, vn['href']))
-            vnet = self._execute_curl_cmd(vn_cmd)
+        if self._args.bulk:
+            query['detail'] = 'true'
+            query['fields'] = 'network_ipam_refs,routing_instances'
+
+        pages = self._iter_list_pages('virtual-network', query)
+        first_page = next(pages)
+        if first_page is None:
+            raise ContrailRouteHelperError(
+                'Virtual networks couldnt be retrieved')
+        return self._iter_network_pages(itertools.chain([first_page], pages))
+
+    def _iter_network_pages(self, pages):
+        for virtual_nets in pages:
+            if virtual_nets is None:
+                raise ContrailRouteHelperError(
+                    'Virtual networks couldnt be retrieved')
+
+            for i in range(0, len(virtual_nets), self.LIST_CHUNK_SIZE):
+                for vnet_info in self._get_virtual_networks_info(
+                        virtual_nets[i:i + self.LIST_CHUNK_SIZE]):
+                    yield vnet_info
+
+    def _get_virtual_networks_info(self, virtual_nets):
+        # get details about the virtual-networks
+        if not self._args.bulk:
+            virtual_nets = self._fetch_all(self._get_object,
+                                           [vn['href'] for vn in virtual_nets])
+        vnets = []
+        for vnet in virtual_nets:
             if not vnet:
                 continue
 
@@ -317,108 +2143,209 @@ class ContrailRouteHelper(object):
             tenant_id = vnet['parent_uuid'].replace("-", "")
             if self._args.tenant_id and self._args.tenant_id != tenant_id:
                 continue
+            vnets.append(vnet)
 
-            vnet_info = {'uuid': vnet['uuid'],
-                         'fq_name': vnet['fq_name'],
-                         'tenant_id': tenant_id}
-            subnets = self._get_vnet_subnets(vnet)
-            vnet_info['subnets'] = subnets
-            routing_instances = self._extract_routing_instances(vnet)
-            vnet_info['routing_instances'] = routing_instances
-            total_virtual_nets.append(vnet_info)
-
-        self._print_virtual_networks(total_virtual_nets)
+        total_virtual_nets = []
+        all_routing_instances = self._extract_all_routing_instances(vnets)
+        for vnet, routing_instances in zip(vnets, all_routing_instances):
+            tenant_id = vnet['parent_uuid'].replace("-", "")
+            total_virtual_nets.append(self._model.virtual_network(
+                vnet['uuid'], vnet['fq_name'], tenant_id,
+                self._get_vnet_subnets(vnet), routing_instances))
+        return total_virtual_nets
 
     def _get_virtual_network(self, network, verbose=True):
+        if self._snapshot:
+            vnet_info = self._snapshot.get_network(network)
+            if not vnet_info:
+                raise ContrailRouteHelperError("Network %s not found "
+                                               % (network))
+            return self._model.virtual_network_from_dict(vnet_info)
+
         try:
             uuid.UUID(network)
             network_id = network
+            fq_name = None
         except:
-            network_id = self._get_id_from_fq_name([network],
-                                                   'virtual-network')
-            if not network_id:
-                print ("Network %s not found " % (network))
-                sys.exit(1)
-
-        vn_cmd = ('%s -s http://%s:%s/virtual-network/%s'
-                  % (self.base_curl_cmd, self._args.api_server,
-                     self._args.api_port, network_id))
-        vnet = self._execute_curl_cmd(vn_cmd, verbose=verbose)
+            network_id = None
+            fq_name = [network]
+
+        vnet = self._read_object('virtual-network', obj_uuid=network_id,
+                                 fq_name=fq_name, verbose=verbose)
         if not vnet:
-            print ("Network %s not found " % (network))
-            sys.exit(1)
+            raise ContrailRouteHelperError("Network %s not found "
+                                           % (network))
 
-        vnet = vnet['virtual-network']
         tenant_id = vnet['parent_uuid'].replace("-", "")
         if self._args.tenant_id and self._args.tenant_id != tenant_id:
             return
 
-        vnet_info = {'uuid': vnet['uuid'],
-                     'fq_name': vnet['fq_name'],
-                     'tenant_id': tenant_id}
         routing_instances = self._extract_routing_instances(vnet)
-        vnet_info['routing_instances'] = routing_instances
-        return vnet_info
+        return self._model.virtual_network(vnet['uuid'], vnet['fq_name'],
+                                           tenant_id,
+                                           routing_instances=routing_instances)
 
     def show_virtual_network(self):
         vnet_info = self._get_virtual_network(self._args.network_id)
-        self._print_virtual_networks([vnet_info])
+        return self._print_virtual_networks([vnet_info])
 
     def _print_virtual_networks(self, virtual_nets):
+        """Print virtual_nets, or return them as a list when quiet.
+
+        The networks are VirtualNetwork objects, they are returned and
+        printed in JSON as dicts.
+        """
+        if self._quiet:
+            return [vnet.to_dict() for vnet in virtual_nets]
+        if self._args.format == 'jsonl':
+            for vnet in virtual_nets:
+                sys.stdout.write('%s\n' % json.dumps(vnet.to_dict()))
+                sys.stdout.flush()
+            return
+        if self._args.format == 'json':
+            sys.stdout.write('[')
+            separator = '\n'
+            for vnet in virtual_nets:
+                sys.stdout.write('%s%s' % (separator,
+                                           json.dumps(vnet.to_dict())))
+                sys.stdout.flush()
+                separator = ',\n'
+            sys.stdout.write('\n]\n')
+            return
+
         print 'Virtual Network details'
         print '********************************'
         for vnet in virtual_nets:
-            print 'Virtual Network uuid - ', vnet['uuid']
-            print 'Virtual Network fq-name - ', vnet['fq_name']
-            print 'Virtual Network tenant id - ', vnet['tenant_id']
+            print 'Virtual Network uuid - ', vnet.uuid
+            print 'Virtual Network fq-name - ', list(vnet.fq_name)
+            print 'Virtual Network tenant id - ', vnet.tenant_id
             print 'Virtual Network subnets :'
-            for subnet in vnet.get('subnets', []):
-                print '\t Subnet uuid - ', subnet['subnet_uuid']
-                print '\t Subnet cidr - ', subnet['cidr']
+            for subnet in vnet.subnets or ():
+                print '\t Subnet uuid - ', subnet.subnet_uuid
+                print '\t Subnet cidr - ', subnet.cidr
             print 'Virtual Network Routing instances :'
-            for ri in vnet['routing_instances']:
-                print '\t Routing Instance uuid - ', ri['uuid']
-                print '\t Routing Instance fq_name - ', ri['fq_name']
-                if ri['route_targets']:
+            for ri in vnet.routing_instances:
+                print '\t Routing Instance uuid - ', ri.uuid
+                print '\t Routing Instance fq_name - ', list(ri.fq_name)
+                if ri.route_targets:
                     print '\t Routing Instance - Route targets :'
-                    for rt in ri['route_targets']:
-                        print '\t\tRoute target fq_name -', rt['fq_name']
-                        print '\t\tRoute target uuid -', rt['uuid']
-                        print '\t\tRoute target -', rt['target']
-                        print '\t\tRoute target direction - ', rt['direction']
+                    for rt, direction in ri.route_targets:
+                        print '\t\tRoute target fq_name -', list(rt.fq_name)
+                        print '\t\tRoute target uuid -', rt.uuid
+                        print '\t\tRoute target -', rt.target
+                        print '\t\tRoute target direction - ', direction
                         print '\t\t%%%%%%%%%%%%%%%%%%%%%%%%%'
                 else:
                     print '\t No Route targets'
 
                 print '\t#######################'
             print '**************************************\n'
+            sys.stdout.flush()
         print '\nEND\n'
 
     def _get_id_from_fq_name(self, fq_name, res_type):
+        return self._resolve_fq_name(fq_name, res_type)[0]
+
+    def _resolve_fq_name(self, fq_name, res_type):
+        """Return the uuid of fq_name and whether it came from the cache."""
+        obj_uuid = self._fqname_cache.get(res_type, fq_name)
+        if obj_uuid:
+            return obj_uuid, True
+
         json_data = {"fq_name": fq_name, "type": res_type}
-        cmd = ('%s -X POST %s/fqname-to-id -H Content-Type:application/json'
-               ' -d '
-               % (self.base_curl_cmd, self.base_url))
-        uuid = self._execute_curl_cmd(cmd, json_data=json_data)
-        return uuid['uuid'] if uuid else None
+        url = '%s/fqname-to-id' % (self.base_url)
+        uuid = self._api_request('POST', url, json_data=json_data)
+        if not uuid:
+            return None, False
+        self._fqname_cache.put(res_type, fq_name, uuid['uuid'])
+        return uuid['uuid'], False
+
+    def _read_object(self, res_type, obj_uuid=None, fq_name=None,
+                     verbose=True):
+        cached = False
+        if not obj_uuid and fq_name:
+            obj_uuid, cached = self._resolve_fq_name(fq_name, res_type)
+        if not obj_uuid:
+            return None
+
+        url = '%s/%s/%s' % (self.base_url, res_type, obj_uuid)
+        obj = self._api_request('GET', url, verbose=verbose)
+        if not obj and cached:
+            # the object was deleted (or re-created) since fq_name was
+            # resolved, resolve it again
+            self._fqname_cache.invalidate(res_type, fq_name)
+            return self._read_object(res_type, fq_name=fq_name,
+                                     verbose=verbose)
+        try:
+            return obj[res_type]
+        except:
+            return None
+
+    def _delete_object(self, res_type, obj_uuid=None, fq_name=None):
+        if not obj_uuid and fq_name:
+            obj_uuid = self._get_id_from_fq_name(fq_name, res_type)
+
+        url = '%s/%s/%s' % (self.base_url, res_type, obj_uuid)
+        response = self._api_request('DELETE', url)
+        self._fqname_cache.invalidate_uuid(obj_uuid)
+        return response
 
     def _read_virtual_network(self, net_id=None, fq_name=None):
         if not id and fq_name:
             # get the id from fq_name
             net_id = self._get_id_from_fq_name(fq_name, 'virtual-network')
-        vn_cmd = ('%s -s http://%s:%s/virtual-network/%s'
-                  % (self.base_curl_cmd, self._args.api_server,
-                     self._args.api_port, net_id))
-        vnet = self._execute_curl_cmd(vn_cmd)
+        vn_url = '%s/virtual-network/%s' % (self.base_url, net_id)
+        vnet = self._api_request('GET', vn_url)
         if vnet:
             vnet = vnet['virtual-network']
         return vnet
 
-    def _generate_rt_key(self, other_key):
-        random_no = random.getrandbits(16)
-        random_no = int(random_no)
-        target_key = int(other_key[2]) + 10000 + random_no
-        return 'target:%s:%d' % (other_key[1], target_key)
+    def _list_route_target_names(self):
+        names = []
+        for route_targets in self._iter_list_pages('route-target', {},
+                                                   use_cache=False):
+            if route_targets is None:
+                raise ContrailRouteHelperError(
+                    'Route targets couldnt be listed')
+            names.extend(rt['fq_name'][-1] for rt in route_targets)
+        return names
+
+    def _get_route_target_allocator(self):
+        """Return the allocator, loaded with one route target listing."""
+        self._rt_allocator.load(self._list_route_target_names)
+        return self._rt_allocator
+
+    def _get_network_asn(self, vn):
+        """Return the ASN of the first route target of vn."""
+        for ri in vn.routing_instances:
+            for rt, _ in ri.route_targets:
+                parsed = RouteTargetAllocator.parse(rt.target)
+                if parsed:
+                    return parsed[0]
+        raise ContrailRouteHelperError(
+            'Network %s has no route target to take the ASN from, use '
+            '--target' % ':'.join(vn.fq_name))
+
+    def _create_unused_route_target(self, asn, number=None):
+        """Create a route target of asn with an unused number.
+
+        number is a number reserved beforehand. A number that someone
+        else used since the route targets were listed is skipped.
+        """
+        allocator = self._get_route_target_allocator()
+        for _ in range(self.RT_ALLOCATION_ATTEMPTS):
+            if number is None:
+                number = allocator.reserve(asn)[0]
+            rt_key = ['target:%s:%d' % (asn, number)]
+            try:
+                return self._create_route_target(rt_key)
+            except ContrailRouteHelperError:
+                if not self._get_route_target(rt_key):
+                    raise
+            number = None
+        raise ContrailRouteHelperError(
+            'No unused route target found for ASN %s after %d attempts'
+            % (asn, self.RT_ALLOCATION_ATTEMPTS))
 
     def _read_or_create_route_target(self, rt_key):
         rt_target = self._get_route_target(rt_key)
@@ -428,36 +2355,22 @@ class ContrailRouteHelper(object):
 
     def _create_route_target(self, rt_key):
         data = {"route-target": {"fq_name": rt_key}}
-        cmd = ('%s -X POST %s/route-targets -H '
-               'Content-Type:application/json -d '
-               % (self.base_curl_cmd, self.base_url))
-        rt_target = self._execute_curl_cmd(cmd, json_data=data)
+        url = '%s/route-targets' % (self.base_url)
+        rt_target = self._api_request('POST', url, json_data=data)
         if not rt_target:
-            print('Creating route target failed : cmd = ' + str(cmd) + '\n')
-            sys.exit(1)
+            raise ContrailRouteHelperError(
+                'Creating route target failed : url = ' + str(url) + '\n')
         rt_target = rt_target['route-target']
+        self._fqname_cache.put('route-target', rt_key, rt_target['uuid'])
+        self._rt_allocator.mark_used(rt_key[0])
         return rt_target
 
     def _delete_route_target(self, rt_uuid=None, rt_key=None):
-        if not rt_uuid and rt_key:
-            rt_uuid = self._get_id_from_fq_name(rt_key, 'route-target')
-
-        cmd = ('%s -X DELETE %s/route-target/%s'
-               % (self.base_curl_cmd, self.base_url, rt_uuid))
-        self._execute_curl_cmd(cmd)
+        return self._delete_object('route-target', obj_uuid=rt_uuid,
+                                   fq_name=rt_key)
 
     def _get_route_target(self, rt_key):
-        rt_uuid = self._get_id_from_fq_name(rt_key, 'route-target')
-        if not rt_uuid:
-            return None
-
-        cmd = ('%s -s %s/route-target/%s'
-               % (self.base_curl_cmd, self.base_url, rt_uuid))
-        try:
-            rt = self._execute_curl_cmd(cmd)['route-target']
-        except:
-            return None
-        return rt
+        return self._read_object('route-target', fq_name=rt_key)
 
     def _read_or_create_routing_instance(self, ri_fq_name):
         routing_instance = self._get_routing_instance(fq_name=ri_fq_name)
@@ -466,32 +2379,21 @@ class ContrailRouteHelper(object):
         return routing_instance
 
     def _get_routing_instance(self, ri_uuid=None, fq_name=None):
-        if not ri_uuid and fq_name:
-            ri_uuid = self._get_id_from_fq_name(fq_name, 'routing-instance')
-
-        if not ri_uuid:
-            return None
-
-        cmd = ('%s -s %s/routing-instance/%s'
-               % (self.base_curl_cmd, self.base_url, ri_uuid))
-        try:
-            ri = self._execute_curl_cmd(cmd)['routing-instance']
-        except:
-            return None
-        return ri
+        return self._read_object('routing-instance', obj_uuid=ri_uuid,
+                                 fq_name=fq_name)
 
     def _create_routing_instance(self, ri_fq_name):
         data = {"routing-instance": {"fq_name": ri_fq_name,
                                      "parent_type": "virtual-network",
                                      "uuid": None}}
-        cmd = ('%s -X POST %s/routing-instances -H '
-               'Content-Type:application/json -d '
-               % (self.base_curl_cmd, self.base_url))
-        rt_target = self._execute_curl_cmd(cmd, json_data=data)
+        url = '%s/routing-instances' % (self.base_url)
+        rt_target = self._api_request('POST', url, json_data=data)
         if not rt_target:
-            print ('Creating routing instance failed : fq_name = '
-                   + str(ri_fq_name) + '\n')
-            return None
+            raise ContrailRouteHelperError(
+                'Creating routing instance failed : fq_name = '
+                + str(ri_fq_name) + '\n')
+        self._fqname_cache.put('routing-instance', ri_fq_name,
+                               rt_target['routing-instance']['uuid'])
         return rt_target['routing-instance']
 
     def _update_routing_instance(self, ri_uuid, rt_uuid, rt_fq_name, action,
@@ -504,69 +2406,223 @@ class ContrailRouteHelper(object):
                      "type": "routing-instance",
                      "attr": {"import_export": direction}}
 
-        cmd = ('%s -X POST %s/ref-update -H Content-Type:application/json '
-               ' -d ' % (self.base_curl_cmd, self.base_url))
-        self._execute_curl_cmd(cmd, json_data=json_data)
+        url = '%s/ref-update' % (self.base_url)
+        return self._api_request('POST', url, json_data=json_data)
 
     def _delete_routing_instance(self, ri_uuid=None, ri_fq_name=None):
-        if not ri_uuid and ri_fq_name:
-            ri_uuid = self._get_id_from_fq_name(ri_fq_name, 'routing-instance')
-
-        cmd = ('%s -X DELETE %s/routing-instance/%s'
-               % (self.base_curl_cmd, self.base_url, ri_uuid))
-        self._execute_curl_cmd(cmd)
+        return self._delete_object('routing-instance', obj_uuid=ri_uuid,
+                                   fq_name=ri_fq_name)
 
     def _get_primary_routing_instance(self, vn):
-        return vn['routing_instances'][0]
+        return vn.routing_instances[0]
 
     def _get_routing_instance_for_vn(self, vn, ri_name):
         if not ri_name:
             return self._get_primary_routing_instance(vn)
-        ri_fq_name = list(vn['fq_name'])
+        ri_fq_name = list(vn.fq_name)
         ri_fq_name.append(ri_name)
-        return self._get_routing_instance(fq_name=ri_fq_name)
+        routing_instance = self._get_routing_instance(fq_name=ri_fq_name)
+        if routing_instance:
+            return self._model.routing_instance_from_object(routing_instance)
 
     def _get_or_create_routing_instance_for_vn(self, vn, ri_name):
         if not ri_name:
             return self._get_primary_routing_instance(vn)
 
-        ri_fq_name = list(vn['fq_name'])
+        ri_fq_name = list(vn.fq_name)
         ri_fq_name.append(ri_name)
-        return self._read_or_create_routing_instance(ri_fq_name)
+        return self._model.routing_instance_from_object(
+            self._read_or_create_routing_instance(ri_fq_name))
+
+    def _invalidate_network(self, vn):
+        """Drop the cached vn after a change to its routing instances.
+
+        The cache only finds the parent of a changed routing instance
+        while the routing instance itself is cached, concurrent updates
+        can leave the network cached with stale routing instances.
+        """
+        self._object_cache.invalidate([vn.uuid])
+
+    def _update_routing_instance_ref(self, update, rt_target, action):
+        """ADD or DELETE the rt_target reference of update['ri']."""
+        ri = update['ri']
+        # a rollback restores the reference as it was
+        for rt, direction in ri.route_targets:
+            if rt.uuid == rt_target['uuid']:
+                update['existed'] = True
+                update['direction'] = direction
+        if not self._update_routing_instance(ri.uuid, rt_target['uuid'],
+                                             rt_target['fq_name'], action):
+            raise ContrailRouteHelperError(
+                'Updating routing instance %s (%s %s) failed'
+                % (':'.join(ri.fq_name), action, rt_target['name']))
+        update['updated'] = True
+        self._invalidate_network(update['vn'])
+
+    def _update_routing_instances(self, vn_list, func, rt_target, action,
+                                  updates=None):
+        """Run func on every network concurrently, all or nothing.
+
+        func(update) updates the routing instance of update['vn'] with
+        _update_routing_instance_ref(), setting update['created_ri'] if
+        it created the routing instance. When one of the calls fails the
+        references updated by the others are reverted and the created
+        routing instances deleted. Returns the failures, after the
+        rollback.
+        """
+        if updates is None:
+            updates = []
+        # a network given twice is updated once
+        vn_uuids = set()
+        for vn in vn_list:
+            if vn.uuid not in vn_uuids:
+                vn_uuids.add(vn.uuid)
+                updates.append({'vn': vn, 'ri': None, 'existed': False,
+                                'direction': None, 'created_ri': False,
+                                'updated': False})
+
+        def _run(update):
+            try:
+                func(update)
+            except ContrailRouteHelperError as e:
+                return '%s : %s' % (':'.join(update['vn'].fq_name),
+                                    str(e).strip())
+
+        failures = [failure for failure in self._fetch_all(_run, updates)
+                    if failure]
+        if not failures:
+            return []
+
+        def _rollback(update):
+            errors = []
+            ri = update['ri']
+            undo = 'ADD' if update['existed'] else 'DELETE'
+            if update['updated'] and not self._update_routing_instance(
+                    ri.uuid, rt_target['uuid'], rt_target['fq_name'], undo,
+                    update['direction']):
+                errors.append('reverting routing instance %s (%s %s) failed'
+                              % (':'.join(ri.fq_name), undo,
+                                 rt_target['name']))
+            if update['created_ri'] and (
+                    self._delete_routing_instance(ri_uuid=ri.uuid) is None):
+                errors.append('deleting routing instance %s failed'
+                              % ':'.join(ri.fq_name))
+            if update['updated'] or update['created_ri']:
+                self._invalidate_network(update['vn'])
+            return errors
+
+        rollback_errors = [error for errors in self._fetch_all(_rollback,
+                                                                updates)
+                           for error in errors]
+        if rollback_errors:
+            failures.append('rolling back failed, %s'
+                            % ', '.join(rollback_errors))
+        else:
+            failures.append('the other changes were rolled back')
+        return failures
 
     def enable_routing(self):
         left_net = self._get_virtual_network(self._args.left_network)
         right_net = self._get_virtual_network(self._args.right_network)
 
-        if self._args.target:
+        # create a route target
+        reserved = getattr(self._args, 'reserved_target', None)
+        if reserved:
+            # reserved by batch for this operation
+            rt_target = self._create_unused_route_target(*reserved)
+            created_rt = True
+        elif self._args.target:
             rt_key = ['target:%s' % (self._args.target)]
+            rt_target = self._get_route_target(rt_key)
+            created_rt = not rt_target
+            if created_rt:
+                rt_target = self._create_route_target(rt_key)
         else:
-            existing_key = (
-                left_net['routing_instances'][0]['route_targets'][0]['target'])
-            existing_key = existing_key.split(':')
-            rt_key = [self._generate_rt_key(existing_key)]
-
-        # create a route target
-        rt_target = self._read_or_create_route_target(rt_key)
-        print 'Created route target : ', rt_target
+            rt_target = self._create_unused_route_target(
+                self._get_network_asn(left_net))
+            created_rt = True
+        self._print('Created route target : %s' % (rt_target,))
 
         # associate the route target to the routing instances of the
         # virtual networks
-        vn_list = [left_net, right_net]
-        for vn in vn_list:
-            ri = self._get_or_create_routing_instance_for_vn(
-                vn, self._args.routing_instance)
-            self._update_routing_instance(ri['uuid'], rt_target['uuid'],
-                                          rt_target['fq_name'], 'ADD')
+        def _add_route_target(update):
+            ri_name = self._args.routing_instance
+            if ri_name:
+                ri_fq_name = list(update['vn'].fq_name) + [ri_name]
+                routing_instance = self._get_routing_instance(
+                    fq_name=ri_fq_name)
+                if not routing_instance:
+                    routing_instance = self._create_routing_instance(
+                        ri_fq_name)
+                    update['created_ri'] = True
+                update['ri'] = self._model.routing_instance_from_object(
+                    routing_instance)
+            else:
+                update['ri'] = self._get_primary_routing_instance(
+                    update['vn'])
+            self._update_routing_instance_ref(update, rt_target, 'ADD')
+
+        failures = self._update_routing_instances(
+            [left_net, right_net], _add_route_target, rt_target, 'ADD')
+        if failures:
+            if created_rt and self._delete_route_target(
+                    rt_target['uuid']) is None:
+                failures.append('deleting route target %s failed'
+                                % rt_target['name'])
+            raise ContrailRouteHelperError('Enabling routing failed : %s'
+                                           % '; '.join(failures))
 
         left_net = self._get_virtual_network(self._args.left_network,
                                              verbose=False)
         right_net = self._get_virtual_network(self._args.right_network,
                                               verbose=False)
-        self._print_virtual_networks([left_net, right_net])
+        return self._print_virtual_networks([left_net, right_net])
+
+    def _get_routing_instances_of_vn(self, vn, ri_name):
+        if not ri_name:
+            return [self._get_primary_routing_instance(vn)]
+        return [ri for ri in vn.routing_instances
+                if ri.fq_name[-1] == ri_name]
 
     def _find_common_rt_target(self, vn_list):
-        return None
+        """Return the fq_name of the route target only vn_list share.
+
+        The targets of the routing instances of the networks are
+        indexed, the ones used by every network are read to drop those
+        also used by other routing instances.
+        """
+        if len(set(vn.uuid for vn in vn_list)) < 2:
+            raise ContrailRouteHelperError(
+                'The networks must be different to find a shared route '
+                'target')
+
+        index = RouteTargetIndex()
+        ri_uuids = set()
+        for vn in vn_list:
+            routing_instances = self._get_routing_instances_of_vn(
+                vn, self._args.routing_instance)
+            index.add(vn, routing_instances)
+            ri_uuids.update(ri.uuid for ri in routing_instances)
+
+        targets = sorted(index.common_targets([vn.uuid for vn in vn_list]))
+        if not targets:
+            self._print('No route target is shared by the networks %s'
+                        % ', '.join(str(list(vn.fq_name)) for vn in vn_list))
+            return None
+
+        route_targets = self._fetch_all(
+            lambda target: self._get_route_target([target]), targets)
+        exclusive = [rt['fq_name'] for rt in route_targets if rt and
+                     set(ri['uuid'] for ri in rt.get(
+                         'routing_instance_back_refs', [])) <= ri_uuids]
+        if len(exclusive) != 1:
+            raise ContrailRouteHelperError(
+                'Route targets shared by the networks : %s, %s. Use '
+                '--target' % (', '.join(targets),
+                              'several of them are used by these networks '
+                              'only' if exclusive else
+                              'they are used by other networks too'))
+        return exclusive[0]
 
     def disable_routing(self):
         left_net = self._get_virtual_network(self._args.left_network)
@@ -578,37 +2634,422 @@ class ContrailRouteHelper(object):
             # find the common target shared between left and right net
             rt_key = self._find_common_rt_target([left_net, right_net])
             if not rt_key:
-                return
+                return []
 
         rt_target = self._get_route_target(rt_key)
         if not rt_target:
-            print ('Route target : %s not found. Exiting..'
-                   % self._args.target)
-            sys.exit()
-        vn_list = [left_net, right_net]
-        for vn in vn_list:
+            # rt_key is the fq_name of the found target without --target
+            raise ContrailRouteHelperError(
+                'Route target : %s not found. Exiting..'
+                % rt_key[0].split(':', 1)[1], status=0)
+
+        def _remove_route_target(update):
+            vn = update['vn']
             ri = self._get_routing_instance_for_vn(vn,
                                                    self._args.routing_instance)
             if not ri:
-                print ('Routing instance %s not found for virtual network [%s]'
-                       % (self._args.routing_instance, str(vn['fq_name'])))
-                continue
-
-            self._update_routing_instance(ri['uuid'], rt_target['uuid'],
-                                          rt_target['fq_name'], 'DELETE')
-
-            if self._args.routing_instance:
-                primary_ri = self._get_primary_routing_instance(vn)
-                if primary_ri['uuid'] != ri['uuid']:
-                    self._delete_routing_instance(ri_uuid=ri['uuid'])
-
+                self._print('Routing instance %s not found for virtual '
+                            'network [%s]' % (self._args.routing_instance,
+                                              str(list(vn.fq_name))))
+                return
+            update['ri'] = ri
+            self._update_routing_instance_ref(update, rt_target, 'DELETE')
+
+        updates = []
+        failures = self._update_routing_instances(
+            [left_net, right_net], _remove_route_target, rt_target,
+            'DELETE', updates=updates)
+        if failures:
+            raise ContrailRouteHelperError('Disabling routing failed : %s'
+                                           % '; '.join(failures))
+
+        # the references are gone, the routing instances created for the
+        # route target and the route target itself can be deleted
+        if self._args.routing_instance:
+            updates = [update for update in updates
+                       if update['ri'] and update['ri'].uuid !=
+                       self._get_primary_routing_instance(update['vn']).uuid]
+            for update, response in zip(updates, self._fetch_all(
+                    lambda update: self._delete_routing_instance(
+                        ri_uuid=update['ri'].uuid), updates)):
+                self._invalidate_network(update['vn'])
+                if response is None:
+                    self._print('Deleting routing instance %s failed'
+                                % update['ri'].uuid)
         self._delete_route_target(rt_target['uuid'])
 
         left_net = self._get_virtual_network(self._args.left_network,
                                              verbose=False)
         right_net = self._get_virtual_network(self._args.right_network,
                                               verbose=False)
-        self._print_virtual_networks([left_net, right_net])
+        return self._print_virtual_networks([left_net, right_net])
+
+    def _get_subnet_trie(self):
+        """Index the subnets of every network in one listing."""
+        trie = PrefixTrie()
+        for vnet in self._iter_virtual_networks():
+            routing_instances = vnet.routing_instances
+            # the primary routing instance is named after the network
+            primary = [ri for ri in routing_instances
+                       if ri.fq_name[-1] == vnet.fq_name[-1]]
+            ri = (primary or routing_instances or [None])[0]
+            network = {'uuid': vnet.uuid, 'fq_name': list(vnet.fq_name),
+                       'tenant_id': vnet.tenant_id}
+            routing_instance = ri and {'uuid': ri.uuid,
+                                       'fq_name': list(ri.fq_name)}
+            for subnet in vnet.subnets or ():
+                try:
+                    trie.insert(subnet.cidr, {
+                        'cidr': subnet.cidr,
+                        'subnet_uuid': subnet.subnet_uuid,
+                        'network': network,
+                        'routing_instance': routing_instance})
+                except ValueError as e:
+                    self._print('Skipping subnet of network %s : %s'
+                                % (list(vnet.fq_name), e))
+        return trie
+
+    def _print_subnet(self, prefix, subnet):
+        ri = subnet['routing_instance']
+        print ('%s\t%s\t%s %s\t%s' % (
+            prefix, subnet['cidr'], ':'.join(subnet['network']['fq_name']),
+            subnet['network']['uuid'],
+            ':'.join(ri['fq_name']) if ri else None))
+
+    def find_ip(self):
+        trie = self._get_subnet_trie()
+        addresses = self._args.addresses
+        if not addresses:
+            addresses = (line.strip() for line in sys.stdin)
+
+        results = []
+        for address in addresses:
+            if not address:
+                continue
+            try:
+                result = {'address': address,
+                          'matches': trie.longest_match(address)}
+            except ValueError as e:
+                result = {'address': address, 'matches': [],
+                          'error': str(e)}
+
+            if self._quiet:
+                results.append(result)
+            elif self._args.format == 'jsonl':
+                sys.stdout.write('%s\n' % json.dumps(result))
+                sys.stdout.flush()
+            elif self._args.format == 'json':
+                results.append(result)
+            elif not result['matches']:
+                print ('%s\t%s' % (address,
+                                    result.get('error', 'NOT FOUND')))
+            else:
+                for subnet in result['matches']:
+                    self._print_subnet(address, subnet)
+
+        if self._quiet:
+            return results
+        if self._args.format == 'json':
+            print json.dumps(results)
+
+    def find_overlaps(self):
+        trie = self._get_subnet_trie()
+        if self._args.cidr:
+            try:
+                results = trie.overlapping(self._args.cidr)
+            except ValueError as e:
+                raise ContrailRouteHelperError(str(e))
+        else:
+            # every overlapping pair is found once, from the longer
+            # prefix (or the greater subnet uuid) on the path to it
+            results = []
+            for subnet in trie.values():
+                length = PrefixTrie.parse(subnet['cidr'])[2]
+                for other in trie.covering(subnet['cidr']):
+                    if other['network']['uuid'] == subnet['network']['uuid']:
+                        continue
+                    other_length = PrefixTrie.parse(other['cidr'])[2]
+                    if other_length < length or (
+                            other_length == length and
+                            other['subnet_uuid'] < subnet['subnet_uuid']):
+                        results.append([subnet, other])
+
+        if self._quiet:
+            return results
+        if self._args.format != 'text':
+            print json.dumps(results)
+            return
+        for result in results:
+            if self._args.cidr:
+                self._print_subnet(self._args.cidr, result)
+                continue
+            subnet, other = result
+            print ('%s\t%s\toverlaps\t%s\t%s' % (
+                subnet['cidr'], ':'.join(subnet['network']['fq_name']),
+                other['cidr'], ':'.join(other['network']['fq_name'])))
+        print '%d overlapping subnets' % len(results)
+
+    def save_snapshot(self):
+        start = time.time()
+        count = ContrailTopologySnapshot.create(
+            self._args.snapshot_file, self._iter_virtual_networks(),
+            '%s:%s' % (self._args.api_server, self._args.api_port))
+        if self._quiet:
+            return {'snapshot_file': self._args.snapshot_file,
+                    'networks': count}
+        print ('Snapshot of %d virtual networks written to %s in %.3fs'
+               % (count, self._args.snapshot_file, time.time() - start))
+
+    def _get_route_target_index(self):
+        """Index the route targets of every network in one listing."""
+        index = RouteTargetIndex()
+        for vnet in self._iter_virtual_networks():
+            index.add(vnet)
+        return index
+
+    def show_connectivity(self):
+        index = self._get_route_target_index()
+
+        def _network(vn_uuid):
+            return {'uuid': vn_uuid,
+                    'fq_name': list(index.networks[vn_uuid].fq_name)}
+
+        if self._args.network:
+            vnet = self._get_virtual_network(self._args.network,
+                                             verbose=False)
+            # the network of another tenant than -t is filtered out
+            if not vnet or vnet.uuid not in index.networks:
+                raise ContrailRouteHelperError(
+                    'Network %s not found ' % self._args.network)
+            vn_uuid = vnet.uuid
+            imports_from = index.imports_from(vn_uuid)
+            exports_to = index.exports_to(vn_uuid)
+            result = {
+                'network': _network(vn_uuid),
+                'imports_from': [_network(uuid)
+                                 for uuid in sorted(imports_from)],
+                'exports_to': [_network(uuid)
+                               for uuid in sorted(exports_to)],
+                'mutual': [_network(uuid) for uuid in
+                           sorted(imports_from & exports_to)]}
+        else:
+            groups = index.get_groups()
+            result = {
+                'groups': [[_network(vn_uuid) for vn_uuid in group]
+                           for group in groups if len(group) > 1],
+                'isolated': [_network(group[0]) for group in groups
+                             if len(group) == 1]}
+
+        if self._quiet:
+            return result
+        if self._args.format != 'text':
+            print json.dumps(result)
+            return
+
+        print 'Virtual Network connectivity'
+        print '********************************'
+        if self._args.network:
+            print 'Virtual Network - ', result['network']['fq_name']
+            for key, title in (('imports_from', 'Imports routes from'),
+                               ('exports_to', 'Exports routes to'),
+                               ('mutual', 'Exchanges routes with')):
+                print '%s :' % title
+                for vnet in result[key]:
+                    print '\t', vnet['fq_name'], vnet['uuid']
+            return
+
+        for number, group in enumerate(result['groups']):
+            print 'Group %d - %d networks :' % (number + 1, len(group))
+            for vnet in group:
+                print '\t', vnet['fq_name'], vnet['uuid']
+        print '********************************'
+        print ('%d networks, %d groups, %d isolated networks'
+               % (len(index.networks), len(result['groups']),
+                  len(result['isolated'])))
+
+    def _get_last_modified(self, res_type, query=None):
+        """Return {uuid: (last_modified, parent_uuid)} of res_type objects.
+
+        Only the id_perms of the objects are listed, or None if the
+        listing fails.
+        """
+        query = dict(query or {}, detail='true', fields='id_perms')
+        objs = {}
+        for page in self._iter_list_pages(res_type, query, use_cache=False):
+            if page is None:
+                return None
+            for obj in page:
+                obj = obj[res_type]
+                objs[obj['uuid']] = (
+                    (obj.get('id_perms') or {}).get('last_modified'),
+                    obj.get('parent_uuid'))
+        return objs
+
+    @staticmethod
+    def _get_changed_uuids(previous, current):
+        return set(obj_uuid for obj_uuid in set(previous) | set(current)
+                   if previous.get(obj_uuid) != current.get(obj_uuid))
+
+    def _read_networks_again(self, vn_uuids):
+        """Return {uuid: vnet_info} of vn_uuids, read from the server."""
+        if self._args.bulk:
+            virtual_nets = [
+                {'virtual-network': vnet} for vnet in self._bulk_list_objects(
+                    'virtual-network', 'obj_uuids', sorted(vn_uuids),
+                    fields=['network_ipam_refs', 'routing_instances'])]
+        else:
+            virtual_nets = [{'href': '%s/virtual-network/%s'
+                             % (self.base_url, vn_uuid)}
+                            for vn_uuid in sorted(vn_uuids)]
+        return dict((vnet.uuid, vnet) for vnet in
+                    self._get_virtual_networks_info(virtual_nets))
+
+    @staticmethod
+    def _get_network_route_targets(vnet):
+        return set((':'.join(ri.fq_name), rt.target, direction)
+                   for ri in vnet.routing_instances
+                   for rt, direction in ri.route_targets)
+
+    def _diff_networks(self, old_vnet, new_vnet):
+        """Return the events turning old_vnet into new_vnet."""
+        now = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        vnet = new_vnet or old_vnet
+        network = {'uuid': vnet.uuid, 'fq_name': list(vnet.fq_name)}
+        old_targets = set()
+        new_targets = set()
+        if old_vnet:
+            old_targets = self._get_network_route_targets(old_vnet)
+        if new_vnet:
+            new_targets = self._get_network_route_targets(new_vnet)
+
+        events = []
+        if not old_vnet:
+            events.append({'time': now, 'event': 'network-added',
+                           'network': network})
+        for event, targets in (
+                ('route-target-removed', old_targets - new_targets),
+                ('route-target-added', new_targets - old_targets)):
+            for ri_name, target, direction in sorted(targets):
+                events.append({'time': now, 'event': event,
+                               'network': network,
+                               'routing_instance': ri_name,
+                               'target': target, 'direction': direction})
+        if not new_vnet:
+            events.append({'time': now, 'event': 'network-removed',
+                           'network': network})
+        return events
+
+    def _print_watch_event(self, event):
+        if self._args.format != 'text':
+            sys.stdout.write('%s\n' % json.dumps(event))
+        elif 'target' in event:
+            sys.stdout.write('%s %s %s %s %s %s\n' % (
+                event['time'], event['event'],
+                ':'.join(event['network']['fq_name']),
+                event['routing_instance'], event['target'],
+                event['direction']))
+        else:
+            sys.stdout.write('%s %s %s %s\n' % (
+                event['time'], event['event'],
+                ':'.join(event['network']['fq_name']),
+                event['network']['uuid']))
+        sys.stdout.flush()
+
+    def watch(self):
+        """Print the route target changes of the networks as they happen.
+
+        The networks are read once. Then, every --interval seconds, only
+        the id_perms of the networks, routing instances and route
+        targets are listed and the networks owning an object added,
+        changed or removed since the previous poll are read again.
+        """
+        # the requests would bury the events
+        self._verbose = False
+        query = {}
+        if self._args.tenant_id:
+            try:
+                query['parent_id'] = str(uuid.UUID(self._args.tenant_id))
+            except:
+                pass
+
+        def _poll():
+            modified = (self._get_last_modified('virtual-network', query),
+                        self._get_last_modified('routing-instance'),
+                        self._get_last_modified('route-target'))
+            return None if None in modified else modified
+
+        # list the timestamps first, a change made while the networks are
+        # read is seen by the next poll
+        modified = _poll()
+        if not modified:
+            raise ContrailRouteHelperError('Objects couldnt be listed')
+        vnets = dict((vnet.uuid, vnet)
+                     for vnet in self._iter_virtual_networks())
+        if self._args.format == 'text':
+            self._print('Watching %d virtual networks' % len(vnets))
+
+        events = []
+        polls = 0
+        try:
+            while not self._args.count or polls < self._args.count:
+                time.sleep(self._args.interval)
+                polls += 1
+                start = time.time()
+                current = _poll()
+                if not current:
+                    self._print('Objects couldnt be listed, retrying')
+                    continue
+
+                changed_vns, changed_ris, changed_rts = [
+                    self._get_changed_uuids(previous, now)
+                    for previous, now in zip(modified, current)]
+                vn_uuids = set(changed_vns)
+                for ri_uuid in changed_ris:
+                    for ri_modified in (modified[1], current[1]):
+                        if ri_uuid in ri_modified:
+                            vn_uuids.add(ri_modified[ri_uuid][1])
+                if changed_rts:
+                    vn_uuids.update(
+                        vnet.uuid for vnet in vnets.values()
+                        if changed_rts & set(
+                            rt.uuid for ri in vnet.routing_instances
+                            for rt, _ in ri.route_targets))
+                # the routing instances of the networks of other tenants
+                vn_uuids &= set(vnets) | set(current[0])
+
+                self._object_cache.invalidate(
+                    changed_vns | changed_ris | changed_rts)
+                read_uuids = vn_uuids & set(current[0])
+                new_vnets = {}
+                if read_uuids:
+                    new_vnets = self._read_networks_again(read_uuids)
+                for vn_uuid in read_uuids - set(new_vnets):
+                    # not read, try again at the next poll
+                    del current[0][vn_uuid]
+                    vn_uuids.discard(vn_uuid)
+
+                for vn_uuid in sorted(vn_uuids):
+                    poll_events = self._diff_networks(vnets.get(vn_uuid),
+                                                      new_vnets.get(vn_uuid))
+                    if vn_uuid in new_vnets:
+                        vnets[vn_uuid] = new_vnets[vn_uuid]
+                    else:
+                        vnets.pop(vn_uuid, None)
+                    for event in poll_events:
+                        if self._quiet:
+                            events.append(event)
+                        else:
+                            self._print_watch_event(event)
+                modified = current
+
+                if self._args.format == 'text':
+                    self._print('Poll %d : %d networks read again in %.3fs'
+                                % (polls, len(read_uuids),
+                                   time.time() - start))
+        except KeyboardInterrupt:
+            pass
+        if self._quiet:
+            return events
 
     def _vn_route_target_update(self, action, direction=None):
         vn = self._get_virtual_network(self._args.network)
@@ -616,46 +3057,380 @@ class ContrailRouteHelper(object):
         rt_target = self._get_route_target(rt_key)
         if not rt_target:
             if direction == 'DELETE':
-                print ('Route target : %s not found. Exiting..'
-                       % self._args.target)
-                sys.exit()
+                raise ContrailRouteHelperError(
+                    'Route target : %s not found. Exiting..'
+                    % self._args.target, status=0)
             else:
-                print ('Route target : %s not found. Creating it..'
-                       % self._args.target)
+                self._print('Route target : %s not found. Creating it..'
+                            % self._args.target)
             rt_target = self._create_route_target(rt_key)
 
         ri = self._get_primary_routing_instance(vn)
-        self._update_routing_instance(ri['uuid'], rt_target['uuid'],
+        self._update_routing_instance(ri.uuid, rt_target['uuid'],
                                       rt_target['fq_name'], action,
                                       direction)
 
-        print ('%sED route target %s network [%s]'
-               % (action, 'to' if action == 'ADD' else 'from',
-                  self._args.network))
-        print ('\n')
+        self._print('%sED route target %s network [%s]'
+                    % (action, 'to' if action == 'ADD' else 'from',
+                       self._args.network))
+        self._print('\n')
 
         if action == 'DELETE':
-            time.sleep(3)
-            print ('Trying to delete the route target %s' % (rt_key))
+            if not self._wait_for_back_ref_removal(rt_target['uuid'],
+                                                   ri.uuid):
+                self._print('Route target %s is still referenced by '
+                            'routing instance %s after %s seconds'
+                            % (rt_key, ri.uuid,
+                               self._args.delete_timeout))
+            self._print('Trying to delete the route target %s' % (rt_key))
             self._delete_route_target(rt_uuid=rt_target['uuid'])
 
         vn = self._get_virtual_network(self._args.network)
-        self._print_virtual_networks([vn])
+        return self._print_virtual_networks([vn])
+
+    def _wait_for_back_ref_removal(self, rt_uuid, ri_uuid):
+        """Poll the route target until ri_uuid no longer refers to it.
+
+        The polls back off exponentially from POLL_MIN_INTERVAL to
+        POLL_MAX_INTERVAL. Returns False if the back reference is still
+        there after --delete-timeout seconds.
+        """
+        url = '%s/route-target/%s' % (self.base_url, rt_uuid)
+        deadline = time.time() + self._args.delete_timeout
+        interval = self.POLL_MIN_INTERVAL
+        while True:
+            rt_target = self._api_request('GET', url, verbose=False,
+                                          use_cache=False)
+            if not rt_target:
+                return True
+            back_refs = rt_target['route-target'].get(
+                'routing_instance_back_refs', [])
+            if ri_uuid not in [ri['uuid'] for ri in back_refs]:
+                return True
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            time.sleep(min(interval, remaining))
+            interval = min(interval * 2, self.POLL_MAX_INTERVAL)
 
     def add_route_target(self):
         direction = self._args.direction
         if direction and (direction != 'import' and direction != 'export'):
-            print 'Invalid direction value. Can be import or export only'
-            sys.exit()
-        self._vn_route_target_update('ADD', direction=direction)
+            raise ContrailRouteHelperError(
+                'Invalid direction value. Can be import or export only',
+                status=0)
+        return self._vn_route_target_update('ADD', direction=direction)
 
     def remove_route_target(self):
-        self._vn_route_target_update('DELETE')
+        return self._vn_route_target_update('DELETE')
+
+    def _is_yaml_manifest(self, manifest, content):
+        """Tell a YAML manifest from a JSON-lines one.
+
+        The extension decides, without one (e.g. stdin) a manifest whose
+        first entry is not a JSON object is YAML.
+        """
+        extension = os.path.splitext(manifest)[1]
+        if extension in ('.yaml', '.yml'):
+            return True
+        if extension in ('.json', '.jsonl'):
+            return False
+        for line in content.splitlines():
+            line = line.strip()
+            if line and not line.startswith('#'):
+                return not line.startswith('{')
+        return False
+
+    def _load_batch_manifest(self, manifest):
+        try:
+            if manifest == '-':
+                content = sys.stdin.read()
+            else:
+                with open(manifest) as f:
+                    content = f.read()
+        except IOError as e:
+            raise ContrailRouteHelperError(
+                'Failed to read the manifest %s : %s' % (manifest, e))
+
+        if self._is_yaml_manifest(manifest, content):
+            if not yaml:
+                raise ContrailRouteHelperError(
+                    'PyYAML is required to read YAML manifests')
+            try:
+                operations = yaml.safe_load(content) or []
+            except yaml.YAMLError as e:
+                raise ContrailRouteHelperError(
+                    'Invalid manifest %s : %s' % (manifest, e))
+        else:
+            try:
+                operations = [json.loads(line)
+                              for line in content.splitlines()
+                              if line.strip() and
+                              not line.lstrip().startswith('#')]
+            except ValueError as e:
+                raise ContrailRouteHelperError(
+                    'Invalid manifest %s : %s' % (manifest, e))
+
+        if not isinstance(operations, list):
+            raise ContrailRouteHelperError(
+                'Invalid manifest %s : expected a list of operations'
+                % manifest)
+        return operations
+
+    def _get_batch_operation_args(self, operation):
+        operation = dict(operation)
+        name = operation.pop('operation', None)
+        if name not in self.BATCH_OPERATIONS:
+            raise ValueError('unknown operation %s' % name)
+
+        argv = []
+        for key, value in sorted(operation.items()):
+            argv.extend(['--%s' % key.replace('_', '-'), str(value)])
+
+        try:
+            return self._command_parsers[name].parse_args(
+                argv, namespace=self._get_global_args())
+        except SystemExit:
+            raise ValueError('invalid arguments %s' % ' '.join(argv))
+
+    def _resolve_batch_networks(self, op_args_list, results):
+        """Resolve every network named in the manifest once.
+
+        The names of the operations are replaced by the uuids. The
+        operations naming a network that does not exist fail, their
+        results are set and they are left out of the returned list.
+        """
+        names = set()
+        for _, op_args in op_args_list:
+            for arg in self.BATCH_NETWORK_ARGS:
+                network = getattr(op_args, arg, None)
+                try:
+                    uuid.UUID(network)
+                except:
+                    if network:
+                        names.add(network)
+        names = sorted(names)
+        network_ids = dict(zip(names, self._fetch_all(
+            lambda name: self._get_id_from_fq_name([name],
+                                                   'virtual-network'),
+            names)))
+
+        resolved = []
+        for index, op_args in op_args_list:
+            missing = [network for network in (
+                getattr(op_args, arg, None)
+                for arg in self.BATCH_NETWORK_ARGS)
+                if network in network_ids and not network_ids[network]]
+            if missing:
+                results[index] = ('FAILED', 0.0, 'Network %s not found'
+                                  % ', '.join(missing))
+                continue
+            for arg in self.BATCH_NETWORK_ARGS:
+                network = getattr(op_args, arg, None)
+                if network in network_ids:
+                    setattr(op_args, arg, network_ids[network])
+            resolved.append((index, op_args))
+        return resolved
+
+    def _get_batch_operation_keys(self, op_args):
+        keys = set()
+        for arg in self.BATCH_NETWORK_ARGS:
+            network = getattr(op_args, arg, None)
+            if network:
+                keys.add(network)
+        if op_args.target:
+            keys.add('target:%s' % op_args.target)
+        return keys
+
+    def _reserve_batch_route_targets(self, op_args_list):
+        """Reserve the route targets of the enable-routing without one.
+
+        The numbers of an ASN are reserved at once, every operation then
+        creates the route target it was given.
+        """
+        op_args_list = [op_args for _, op_args in op_args_list
+                        if op_args.func.__name__ == 'enable_routing' and
+                        not op_args.target]
+        if not op_args_list:
+            return
+
+        def _get_asn(op_args):
+            try:
+                return self._get_network_asn(self._get_virtual_network(
+                    op_args.left_network, verbose=False))
+            except ContrailRouteHelperError:
+                # the operation fails the same way when it runs
+                return None
+
+        # reading a network uses the worker pool, the networks are read
+        # by the batch workers
+        pool = ThreadPool(max(self._args.workers, 1))
+        try:
+            asns = pool.map(_get_asn, op_args_list, chunksize=1)
+        finally:
+            pool.close()
+        by_asn = collections.OrderedDict()
+        for op_args, asn in zip(op_args_list, asns):
+            if asn:
+                by_asn.setdefault(asn, []).append(op_args)
+        allocator = self._get_route_target_allocator()
+        for asn, asn_op_args in by_asn.items():
+            numbers = allocator.reserve(asn, len(asn_op_args))
+            for op_args, number in zip(asn_op_args, numbers):
+                op_args.target = '%s:%d' % (asn, number)
+                op_args.reserved_target = (asn, number)
+
+    def _run_batch_operation(self, op_args):
+        helper = self._get_command_helper(op_args)
+        start = time.time()
+        try:
+            getattr(helper, op_args.func.__name__)()
+            status, message = 'OK', ''
+        except ContrailRouteHelperError as e:
+            status, message = 'FAILED', str(e).strip()
+        except SystemExit as e:
+            status, message = 'FAILED', 'exited (%s)' % e.code
+        except Exception as e:
+            status, message = 'FAILED', '%s: %s' % (type(e).__name__, e)
+        return status, time.time() - start, message
+
+    def batch(self):
+        start = time.time()
+        self._verbose = False
+        operations = self._load_batch_manifest(self._args.manifest)
+        results = [None] * len(operations)
+        op_args_list = []
+        for index, operation in enumerate(operations):
+            try:
+                op_args_list.append((index,
+                                     self._get_batch_operation_args(
+                                         operation)))
+            except (ValueError, TypeError, AttributeError) as e:
+                results[index] = ('FAILED', 0.0, str(e))
+
+        op_args_list = self._resolve_batch_networks(op_args_list, results)
+        self._reserve_batch_route_targets(op_args_list)
+
+        # operations sharing a network or a route target run one after
+        # the other in manifest order, the resulting groups concurrently
+        op_groups = DisjointSet()
+        key_owners = {}
+        for index, op_args in op_args_list:
+            op_groups.add(index)
+            for key in self._get_batch_operation_keys(op_args):
+                if key in key_owners:
+                    op_groups.union(key_owners[key], index)
+                else:
+                    key_owners[key] = index
+        groups = collections.OrderedDict()
+        for index, op_args in op_args_list:
+            groups.setdefault(op_groups.find(index), []).append(
+                (index, op_args))
+        groups = groups.values()
+
+        def _run_group(group):
+            return [(index, self._run_batch_operation(op_args))
+                    for index, op_args in group]
+
+        pool = ThreadPool(max(self._args.workers, 1))
+        try:
+            for group_results in pool.imap_unordered(_run_group, groups):
+                for index, result in group_results:
+                    results[index] = result
+        finally:
+            pool.close()
+        elapsed = time.time() - start
+
+        if self._quiet:
+            return [{'operation': (operation.get('operation')
+                                   if isinstance(operation, dict) else None),
+                     'status': status, 'elapsed': op_elapsed,
+                     'message': message}
+                    for operation, (status, op_elapsed, message)
+                    in zip(operations, results)]
+
+        print 'Batch results'
+        print '********************************'
+        for index, (operation, result) in enumerate(zip(operations,
+                                                        results)):
+            status, op_elapsed, message = result
+            name = (operation.get('operation')
+                    if isinstance(operation, dict) else None)
+            print ('%4d %-20s %-7s %8.3fs %s'
+                   % (index + 1, name, status, op_elapsed, message))
+        print '********************************'
+        failed = len([r for r in results if r[0] != 'OK'])
+        print ('%d operations, %d succeeded, %d failed in %.3fs '
+               '(%.2f operations/s)'
+               % (len(results), len(results) - failed, failed, elapsed,
+                  len(results) / elapsed if elapsed else 0.0))
+        if failed:
+            raise ContrailRouteHelperError('%d operations failed' % failed)
+
+    def serve_request(self, request):
+        """Run the command of a serve request and return the response."""
+        try:
+            if not isinstance(request, dict) or 'args' not in request:
+                raise ContrailRouteHelperError(
+                    'Invalid request : expected {"args": ...}')
+            args = self._split_args(request['args'])
+            if args and args[0] in ('serve', 'batch', 'watch'):
+                raise ContrailRouteHelperError(
+                    'Command %s cannot be served' % args[0])
+            response = {'result': self.run(args)}
+        except ContrailRouteHelperError as e:
+            response = {'error': str(e).strip(), 'status': e.status}
+        except Exception as e:
+            response = {'error': '%s: %s' % (type(e).__name__, e),
+                        'status': 1}
+        finally:
+            self._fqname_cache.save()
+        return response
+
+    def serve(self):
+        """Run the commands sent to a unix socket until terminated.
+
+        A client writes one JSON request per line, {"args": "show
+        <network>"} or {"args": ["show", "<network>"]}, and reads one
+        JSON line per request: {"result": ...} with the result of run()
+        or {"error": "...", "status": N}. All the commands share the
+        connections and caches of this process.
+        """
+        self._object_cache = ContrailObjectCache(self._args.cache_size,
+                                                 ttl=self._args.cache_ttl)
+        socket_dir = os.path.dirname(self._args.socket)
+        if socket_dir and not os.path.isdir(socket_dir):
+            os.makedirs(socket_dir)
+        if os.path.exists(self._args.socket):
+            os.unlink(self._args.socket)
+        server = ContrailRouteServer(self._args.socket, self)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        print ('Serving on %s' % self._args.socket)
+        sys.stdout.flush()
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            os.unlink(self._args.socket)
 
 
 def main(args_str=None):
-    route_helper = ContrailRouteHelper(args_str)
-    route_helper._args.func()
+    route_helper = None
+    try:
+        route_helper = ContrailRouteHelper(args_str)
+        if not hasattr(route_helper._args, 'func'):
+            route_helper._parser.error('too few arguments')
+        route_helper._start_deadline()
+        route_helper._args.func()
+    except ContrailRouteHelperError as e:
+        print (str(e))
+        sys.exit(e.status)
+    finally:
+        if route_helper:
+            route_helper.report_trace()
 
 if __name__ == '__main__':
     main()
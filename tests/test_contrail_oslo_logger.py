@@ -0,0 +1,182 @@
+"""Tests of contrail_oslo_logger.py, skipped without oslo_log.
+
+ python -m unittest discover tests
+"""
+
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+LOGGER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          os.pardir, 'contrail_oslo_logger')
+sys.path.insert(0, LOGGER_DIR)
+
+import contrail_oslo_ring_dump
+try:
+    import contrail_oslo_logger
+except ImportError:
+    contrail_oslo_logger = None
+
+
+@unittest.skipUnless(contrail_oslo_logger,
+                     'oslo_log and pysandesh are not installed')
+class RingBufferHandlerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'ring')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_non_ascii_records(self):
+        messages = [u'caf\xe9 %s']
+        if str is bytes:
+            # a python 2 str holding utf-8
+            messages.append(u'caf\xe9 %s'.encode('utf-8'))
+        handler = contrail_oslo_logger._RingBufferHandler(self.path, 4096)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        for number, msg in enumerate(messages):
+            handler.handle(logging.makeLogRecord(
+                {'msg': msg, 'args': (number,), 'levelno': logging.DEBUG}))
+        handler.close()
+
+        records = list(contrail_oslo_ring_dump.iter_records(
+            contrail_oslo_ring_dump.read_ring(self.path)))
+        self.assertEqual(
+            [(number + 1, (u'caf\xe9 %d' % number).encode('utf-8'))
+             for number in range(len(messages))], records)
+
+
+@unittest.skipUnless(contrail_oslo_logger,
+                     'oslo_log and pysandesh are not installed')
+class ContrailOsloLoggerTest(unittest.TestCase):
+
+    generators = 50
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        root = logging.getLogger()
+        self.root_handlers = list(root.handlers)
+        self.root_level = root.level
+        self.calls = dict.fromkeys(('set_defaults', 'register_options',
+                                    'setup', 'getLogger'), 0)
+        self.oslo_functions = {}
+        oslo_log = contrail_oslo_logger.logging
+        for name in self.calls:
+            self.oslo_functions[name] = getattr(oslo_log, name)
+            setattr(oslo_log, name, self.count(name))
+
+    def tearDown(self):
+        for name, function in self.oslo_functions.items():
+            setattr(contrail_oslo_logger.logging, name, function)
+        contrail_oslo_logger.flush_async_logging()
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            if handler not in self.root_handlers:
+                root.removeHandler(handler)
+                handler.close()
+        root.setLevel(self.root_level)
+        shutil.rmtree(self.tmp_dir)
+
+    def count(self, name):
+        function = getattr(contrail_oslo_logger.logging, name)
+
+        def _count(*args, **kwargs):
+            self.calls[name] += 1
+            return function(*args, **kwargs)
+        return _count
+
+    def write_config(self, name):
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, 'w') as f:
+            f.write('[DEFAULT]\nuse_stderr = False\nlog_file = %s\n'
+                    % os.path.join(self.tmp_dir, '%s.log' % name))
+        return path
+
+    def test_setup_once_per_config_file(self):
+        config_file = self.write_config('first.conf')
+        contrail_oslo_logger.ContrailOsloLogger('generator-0', config_file)
+        self.assertEqual(1, self.calls['setup'])
+        self.assertEqual(1, self.calls['getLogger'])
+
+        # the next loggers only cost a getLogger()
+        calls = dict(self.calls)
+        for i in range(1, self.generators):
+            contrail_oslo_logger.ContrailOsloLogger('generator-%d' % i,
+                                                    config_file)
+        calls['getLogger'] += self.generators - 1
+        self.assertEqual(calls, self.calls)
+
+        # another file is set up again, once
+        config_file = self.write_config('second.conf')
+        for i in range(2):
+            contrail_oslo_logger.ContrailOsloLogger('generator-%d' % i,
+                                                    config_file)
+        self.assertEqual(2, self.calls['setup'])
+
+
+class RecordingHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+@unittest.skipUnless(contrail_oslo_logger,
+                     'oslo_log and pysandesh are not installed')
+class LogSuppressionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.handler = RecordingHandler()
+        self.logger = logging.getLogger('test-log-suppression')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.DEBUG)
+        self.logger.addHandler(self.handler)
+        self.suppressor = contrail_oslo_logger._log_suppressor
+
+    def tearDown(self):
+        # stop the flush timer
+        contrail_oslo_logger._log_suppressor.flush()
+        contrail_oslo_logger._log_suppressor = self.suppressor
+        self.logger.removeHandler(self.handler)
+
+    def set_suppressor(self, collapse_duplicates):
+        contrail_oslo_logger._log_suppressor = (
+            contrail_oslo_logger._LogSuppressor(
+                0, 10, {}, logging.CRITICAL, collapse_duplicates))
+
+    def test_caller_of_the_records(self):
+        self.set_suppressor(True)
+        contrail_oslo_logger._install_log_suppression(self.logger)
+        self.logger.info('first')
+        line = sys._getframe().f_lineno - 1
+        record = self.handler.records[-1]
+        self.assertEqual(
+            (os.path.splitext(__file__)[0], line,
+             'test_caller_of_the_records'),
+            (os.path.splitext(record.pathname)[0], record.lineno,
+             record.funcName))
+
+    def test_reconfigured_suppressor(self):
+        self.set_suppressor(False)
+        contrail_oslo_logger._install_log_suppression(self.logger)
+        for _ in range(3):
+            self.logger.info('same')
+        self.assertEqual(3, len(self.handler.records))
+
+        # the logger installed before uses the new suppressor
+        self.set_suppressor(True)
+        for _ in range(3):
+            self.logger.info('same')
+        self.assertEqual(4, len(self.handler.records))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,424 @@
+"""Tests of contrail_ri_util.py against the fake API server.
+
+ python -m unittest discover tests
+"""
+
+import distutils.spawn
+import json
+import os
+import shutil
+import socket
+import StringIO
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import uuid
+
+TOP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       os.pardir)
+sys.path.insert(0, TOP_DIR)
+sys.path.insert(0, os.path.join(TOP_DIR, 'benchmarks'))
+
+import contrail_ri_util
+from fake_contrail_api import FakeContrailApiServer
+
+
+class ContrailRouteHelperTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeContrailApiServer(('127.0.0.1', 0),
+                                            latency=0.002)
+        self.server.start()
+        self.cache_dir = tempfile.mkdtemp()
+        vns = sorted((obj for obj in self.server.topology.objects.values()
+                      if obj['_type'] == 'virtual-network'),
+                     key=lambda obj: obj['fq_name'])
+        self.left, self.right = vns[0]['uuid'], vns[1]['uuid']
+        self.helpers = []
+
+    def tearDown(self):
+        for helper in self.helpers:
+            for pool in helper._connection_pools.values():
+                pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.cache_dir)
+
+    def get_helper(self, options=''):
+        host, port = self.server.server_address
+        helper = contrail_ri_util.ContrailRouteHelper(
+            '-U admin -P secret -s %s -p %d --fqname-cache-file %s %s'
+            % (host, port, os.path.join(self.cache_dir, 'fqname.json'),
+               options))
+        self.helpers.append(helper)
+        return helper
+
+    def call(self, func, *args):
+        """Return the result of func(*args) and what it printed.
+
+        What it printed to stderr is dropped.
+        """
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = StringIO.StringIO(), StringIO.StringIO()
+        try:
+            result = func(*args)
+            return result, sys.stdout.getvalue()
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+
+    def test_disable_routing_routing_instance_concurrent(self):
+        helper = self.get_helper('--concurrency 8')
+        routing = ('--left-network %s --right-network %s '
+                   '--routing-instance extra' % (self.left, self.right))
+        # the concurrent updates race, try a few times
+        for _ in range(5):
+            result, _ = self.call(helper.run, 'enable-routing %s' % routing)
+            self.assertEqual(
+                [['extra'], ['extra']],
+                [[ri['fq_name'][-1] for ri in vnet['routing_instances']
+                  if ri['fq_name'][-1] == 'extra'] for vnet in result])
+
+            result, output = self.call(helper.run,
+                                       'disable-routing %s' % routing)
+            self.assertNotIn('error response', output)
+            self.assertEqual(
+                [[], []],
+                [[ri['fq_name'][-1] for ri in vnet['routing_instances']
+                  if ri['fq_name'][-1] == 'extra'] for vnet in result])
+
+    def test_routing_commands_json_output(self):
+        routing = ('--left-network %s --right-network %s --target 64512:4243'
+                   % (self.left, self.right))
+        for output_format in ('json', 'jsonl'):
+            for command in ('enable-routing', 'disable-routing'):
+                helper = self.get_helper('-f %s %s %s' % (
+                    output_format, command, routing))
+                helper._start_deadline()
+                _, output = self.call(helper._args.func)
+                # stdout only carries the networks
+                if output_format == 'json':
+                    vnets = json.loads(output)
+                else:
+                    vnets = [json.loads(line)
+                             for line in output.splitlines()]
+                self.assertEqual([self.left, self.right],
+                                 [vnet['uuid'] for vnet in vnets])
+
+    def test_list_fails_without_networks(self):
+        host, port = self.server.server_address
+        self.server.shutdown()
+        self.server.server_close()
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            with self.assertRaises(SystemExit) as context:
+                contrail_ri_util.main(
+                    '-U admin -P secret -s %s -p %d --fqname-cache-file %s '
+                    '--retries 0 list' % (host, port, os.path.join(
+                        self.cache_dir, 'fqname.json')))
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(1, context.exception.code)
+        self.assertNotIn('Virtual Network details', output)
+        self.assertNotIn('END', output)
+
+    def test_connectivity_of_a_network_of_another_tenant(self):
+        helper = self.get_helper('-t %s' % uuid.uuid4().hex)
+        with self.assertRaises(contrail_ri_util.ContrailRouteHelperError) \
+                as context:
+            self.call(helper.run, 'connectivity --network %s' % self.left)
+        self.assertIn('Network %s not found' % self.left,
+                      str(context.exception))
+
+    def test_batch_resolves_the_networks_once(self):
+        topology = self.server.topology
+        topology.fq_names[('virtual-network', ('left',))] = self.left
+        topology.fq_names[('virtual-network', ('right',))] = self.right
+        manifest = os.path.join(self.cache_dir, 'manifest')
+        with open(manifest, 'w') as f:
+            for target in range(4242, 4246):
+                f.write(json.dumps({
+                    'operation': 'add-route-target', 'network': 'left',
+                    'target': '64512:%d' % target}) + '\n')
+            f.write(json.dumps({
+                'operation': 'enable-routing', 'left-network': 'left',
+                'right-network': 'right', 'target': '64512:4246'}) + '\n')
+            f.write(json.dumps({
+                'operation': 'add-route-target', 'network': 'missing',
+                'target': '64512:4247'}) + '\n')
+        helper = self.get_helper('--fqname-cache-ttl 0')
+        resolved = []
+        resolve_fq_name = contrail_ri_util.ContrailRouteHelper.__dict__[
+            '_resolve_fq_name']
+
+        def _resolve_fq_name(helper, fq_name, res_type):
+            if res_type == 'virtual-network':
+                resolved.append(fq_name)
+            return resolve_fq_name(helper, fq_name, res_type)
+
+        contrail_ri_util.ContrailRouteHelper._resolve_fq_name = (
+            _resolve_fq_name)
+        try:
+            results, _ = self.call(helper.run, 'batch %s' % manifest)
+        finally:
+            contrail_ri_util.ContrailRouteHelper._resolve_fq_name = (
+                resolve_fq_name)
+        self.assertEqual(['OK'] * 5 + ['FAILED'],
+                         [result['status'] for result in results])
+        self.assertEqual('Network missing not found', results[-1]['message'])
+        self.assertEqual([['left'], ['missing'], ['right']],
+                         sorted(resolved))
+
+    def test_batch_manifest_format(self):
+        helper = self.get_helper()
+        operation = ('{"operation": "add-route-target", "network": "left", '
+                     '"target": "64512:4242"}')
+        yaml_operation = ('- operation: add-route-target\n'
+                          '  network: left\n  target: "64512:4242"\n')
+        self.assertFalse(helper._is_yaml_manifest(
+            '-', '# operations\n\n%s\n' % operation))
+        self.assertTrue(helper._is_yaml_manifest(
+            '-', '# operations\n\n%s' % yaml_operation))
+        self.assertTrue(helper._is_yaml_manifest('batch.yml', operation))
+        self.assertFalse(helper._is_yaml_manifest('batch.jsonl',
+                                                  yaml_operation))
+
+    @unittest.skipUnless(distutils.spawn.find_executable('curl'),
+                         'curl is not installed')
+    def test_curl_transport_delete(self):
+        helper = self.get_helper('--transport curl')
+        rt_target, _ = self.call(helper._create_route_target,
+                                 ['target:64512:4242'])
+        # a DELETE returns an empty body, like with the http transport
+        response, _ = self.call(helper._delete_route_target,
+                                rt_target['uuid'])
+        self.assertEqual({}, response)
+        response, output = self.call(helper._delete_route_target,
+                                     rt_target['uuid'])
+        self.assertIsNone(response)
+        self.assertIn('404', output)
+
+
+class ClosingHttpServer(object):
+    """HTTP server closing the connection after every response.
+
+    The responses don't say it, the client keeps the connection.
+    """
+
+    def __init__(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.bind(('127.0.0.1', 0))
+        self.socket.listen(5)
+        self.address = self.socket.getsockname()
+        self.requests = 0
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                conn, _ = self.socket.accept()
+            except socket.error:
+                return
+            data = ''
+            while '\r\n\r\n' not in data:
+                data += conn.recv(4096)
+            self.requests += 1
+            conn.sendall('HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\n{}')
+            conn.close()
+
+    def close(self):
+        self.socket.close()
+
+
+class ContrailApiConnectionPoolTest(unittest.TestCase):
+
+    def test_closed_idle_connection_is_retried(self):
+        server = ClosingHttpServer()
+        pool = contrail_ri_util.ContrailApiConnectionPool(
+            server.address[0], server.address[1], {}, pool_size=1)
+        try:
+            for _ in range(3):
+                self.assertEqual((200, '{}'),
+                                 pool.request('GET', '/virtual-networks'))
+        finally:
+            pool.close()
+            server.close()
+        self.assertEqual(3, server.requests)
+
+    def test_timeout_is_not_retried(self):
+        server = FakeContrailApiServer(('127.0.0.1', 0), latency=0.3)
+        server.start()
+        host, port = server.server_address
+        pool = contrail_ri_util.ContrailApiConnectionPool(host, port, {},
+                                                          pool_size=1)
+        try:
+            pool.request('GET', '/virtual-networks')
+            server.reset_counters()
+            # the server creates the route target after the timeout
+            with self.assertRaises(socket.timeout):
+                pool.request('POST', '/route-targets', json.dumps(
+                    {'route-target': {'fq_name': ['target:64512:4244']}}),
+                    timeout=0.1)
+            time.sleep(0.5)
+            self.assertEqual(1, server.request_count)
+        finally:
+            pool.close()
+            server.shutdown()
+            server.server_close()
+
+
+class ContrailFqNameCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'cache', 'fqname.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def get_cache(self):
+        return contrail_ri_util.ContrailFqNameCache(self.path, 'server',
+                                                    3600, 10000)
+
+    def test_concurrent_saves(self):
+        cache = self.get_cache()
+
+        def _put_and_save(thread):
+            for i in range(50):
+                cache.put('virtual-network', ['vn%d-%d' % (thread, i)],
+                          str(uuid.uuid4()))
+                cache.save()
+
+        threads = [threading.Thread(target=_put_and_save, args=(thread,))
+                   for thread in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        with open(self.path) as f:
+            self.assertEqual(400, len(json.load(f)))
+
+    def test_failed_save_keeps_the_changes(self):
+        # the cache directory can't be created over a file
+        with open(os.path.dirname(self.path), 'w'):
+            pass
+        cache = self.get_cache()
+        cache.put('virtual-network', ['vn'], 'vn-uuid')
+        stderr = sys.stderr
+        sys.stderr = StringIO.StringIO()
+        try:
+            cache.save()
+            self.assertIn('Failed to write the fq_name cache',
+                          sys.stderr.getvalue())
+        finally:
+            sys.stderr = stderr
+
+        os.unlink(os.path.dirname(self.path))
+        cache.save()
+        self.assertEqual('vn-uuid', self.get_cache().get('virtual-network',
+                                                         ['vn']))
+
+
+class PrefixTrieTest(unittest.TestCase):
+
+    def setUp(self):
+        self.trie = contrail_ri_util.PrefixTrie()
+
+    def test_ipv6(self):
+        self.trie.insert('2001:db8::/32', 'site')
+        self.trie.insert('2001:db8:1::/48', 'vn1')
+        self.trie.insert('10.0.0.0/8', 'v4')
+        self.assertEqual(['vn1'], self.trie.longest_match('2001:db8:1::5'))
+        self.assertEqual(['site'], self.trie.longest_match('2001:db8:2::5'))
+        self.assertEqual([], self.trie.longest_match('2001:db9::1'))
+        self.assertEqual(['site', 'vn1'],
+                         self.trie.covering('2001:db8:1:2::/64'))
+        self.assertEqual(['site', 'vn1'],
+                         sorted(self.trie.overlapping('2001:db8::/31')))
+        # the families don't mix
+        self.assertEqual([], self.trie.longest_match('::a00:1'))
+
+    def test_default_route(self):
+        self.trie.insert('0.0.0.0/0', 'default')
+        self.trie.insert('10.1.0.0/16', 'vn1')
+        self.assertEqual(['default'], self.trie.longest_match('192.0.2.1'))
+        self.assertEqual(['vn1'], self.trie.longest_match('10.1.2.3'))
+        self.assertEqual(['default', 'vn1'],
+                         sorted(self.trie.overlapping('0.0.0.0/0')))
+        self.assertEqual(['default'], self.trie.covering('0.0.0.0/0'))
+        self.assertEqual([], self.trie.longest_match('::1'))
+
+    def test_duplicate_prefixes(self):
+        self.trie.insert('10.1.0.0/16', 'vn1')
+        self.trie.insert('10.1.0.0/16', 'vn2')
+        self.assertEqual(['vn1', 'vn2'], self.trie.longest_match('10.1.2.3'))
+        self.assertEqual(['vn1', 'vn2'], self.trie.covering('10.1.2.0/24'))
+        self.assertEqual(['vn1', 'vn2'],
+                         sorted(self.trie.overlapping('10.0.0.0/8')))
+        self.assertEqual(['vn1', 'vn2'], sorted(self.trie.values()))
+
+    def test_overlapping_past_a_missing_node(self):
+        self.trie.insert('10.0.0.0/8', 'vn1')
+        self.trie.insert('10.1.0.0/16', 'vn2')
+        # the path of 10.2.0.0/16 ends below 10.0.0.0/8, in no subtree
+        self.assertEqual(['vn1'], self.trie.overlapping('10.2.0.0/16'))
+        self.assertEqual([], self.trie.overlapping('11.0.0.0/8'))
+        self.assertEqual(['vn1', 'vn2'],
+                         sorted(self.trie.overlapping('10.0.0.0/12')))
+
+    def test_invalid_prefixes(self):
+        for prefix in ('10.0.0.0/33', '2001:db8::/129', '10.0.0/8',
+                       '10.0.0.0/x'):
+            self.assertRaises(ValueError, self.trie.insert, prefix, 'vn')
+
+
+class SmallRouteTargetAllocator(contrail_ri_util.RouteTargetAllocator):
+
+    LAST_NUMBER = 20
+
+
+class RouteTargetAllocatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.allocator = contrail_ri_util.RouteTargetAllocator()
+
+    def mark_used(self, allocator, numbers):
+        for number in numbers:
+            allocator.mark_used('target:64512:%d' % number)
+
+    def test_full_bytes_are_skipped(self):
+        self.mark_used(self.allocator, range(1, 16) + [17])
+        self.assertEqual([16, 18], self.allocator.reserve('64512', 2))
+        # a full byte reached from the middle of the previous one
+        self.mark_used(self.allocator, range(19, 33))
+        self.assertEqual([33], self.allocator.reserve('64512'))
+
+    def test_reserve_after_mark_used(self):
+        self.assertEqual([1], self.allocator.reserve('64512'))
+        self.mark_used(self.allocator, [3, 4, 7])
+        self.assertEqual([2, 5, 6, 8], self.allocator.reserve('64512', 4))
+        # the numbers already handed out are not reserved again
+        self.mark_used(self.allocator, [1])
+        self.assertEqual([9], self.allocator.reserve('64512'))
+        # every ASN has its own numbers
+        self.assertEqual([1, 2], self.allocator.reserve('64513', 2))
+
+    def test_last_number(self):
+        allocator = SmallRouteTargetAllocator()
+        # the numbers past the last one are the API server's
+        self.mark_used(allocator, range(1, 18) + [21, 8000000])
+        with self.assertRaises(contrail_ri_util.ContrailRouteHelperError):
+            allocator.reserve('64512', 4)
+        # the failed reservation used none of the numbers left
+        self.assertEqual([18, 19, 20], allocator.reserve('64512', 3))
+        with self.assertRaises(contrail_ri_util.ContrailRouteHelperError):
+            allocator.reserve('64512')
+
+
+if __name__ == '__main__':
+    unittest.main()